@@ -7,15 +7,24 @@
 # author: Oliver Bartley
 # date: 31 Aug 2012
 
-import os, argparse, sys, types, httplib, signal
+import os, re, stat, argparse, sys, types, httplib, urllib, socket, Queue, signal, threading, itertools, heapq, bisect, operator, cPickle, mmap, time, gzip, zlib, mimetypes, hashlib, struct, json
+from collections import OrderedDict, MutableMapping
 from random import Random
-from bottle import route, request, response, run, debug, HTTPError, MultiDict
+from array import array
+from StringIO import StringIO
+from bottle import route, request, response, run, debug, parse_date, default_app, Router, RouteSyntaxError, HTTPError, HTTPResponse, MultiDict
 
 ################################################################################
 # Module Definition
 ################################################################################
 # define the virtual module "cork"'s helper functions and classes
 
+_MASK64 = (1 << 64) - 1
+
+# the fake data files that ship with cork, see Pseudorandom.first_name() and friends
+_corpora = dict((name, os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpora", name + ".txt"))
+                for name in ("first_names", "last_names", "streets", "cities", "companies"))
+
 class Pseudorandom(Random):
     '''
     Pseudorandom works by maintaining the state of a random number generator
@@ -24,6 +33,22 @@ class Pseudorandom(Random):
     '''
     _seed = None
     
+    # characters that random_string() replaces, and what they're replaced with
+    _chars = {"#": "0123456789",
+              "$": "ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+              "*": "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+             }
+    _patterns = {} # pattern -> compiled pattern, shared by every instance. See _compile()
+    _seeds = {} # memoised hash_args() results, keyed by the args and their types
+    _memoisable = frozenset([str, unicode, int, long, bool, type(None)])
+    _alias_tables = {} # tuple of weights -> AliasTable, shared by every instance
+    _corpus_indexes = {} # corpus name -> LineIndex, for the bundled corpora. See _corpus_line()
+    
+    # used alongside the bundled corpora
+    _street_suffixes = ("Street", "Avenue", "Road", "Lane", "Drive", "Court", "Boulevard", "Way", "Place")
+    _company_suffixes = ("Inc.", "LLC", "Ltd.", "Corp.", "Group", "Industries", "Holdings", "& Co.")
+    _email_domains = ("example.com", "example.net", "example.org") # reserved for examples by RFC 2606
+    
     def __new__(self, *args, **kwargs):
         '''
         for reasons unbeknownst to me, this is required to subclass Random()
@@ -31,43 +56,126 @@ class Pseudorandom(Random):
         return super(Pseudorandom, self).__new__(self)
 
     def __init__(self, *args):
-        Random.__init__(self)
+        # Random.__init__() would only seed the generator for us to seed it again, so it's skipped
         self.seed(*args)
         
     def seed(self, *args):
         '''overridden seed method, now accepts an iterable container of hashable objects'''
-        self._seed = self.hash_args(*args)
-        super(Pseudorandom, self).seed(self._seed)
-        return self._seed
+        return self._reseed(self.hash_args(*args))
+
+    def _reseed(self, seed):
+        # seed the generator with an already hashed 64-bit seed
+        self._seed = seed
+        super(Pseudorandom, self).seed(seed)
+        return seed
         
     def hash_args(self, *args):
         '''
-        When passed a list of args, will iterate over each args and XOR it to previous hashes to generat this instance's seed value
-        from a list of hashable objects. If an object is not hashable, we attempt to convert it into a string before hashing.
+        When passed a list of args, hashes them in to a 64-bit seed value.
+        Unlike Python's hash(), the result is the same in every process and on every machine,
+        and it depends on the order of the args, so (1, 2) and (2, 1) give different seeds.
+        Numbers, strings, booleans and None, and lists, tuples, sets and dicts of them, are hashed by value;
+        anything else is converted into a string before hashing.
         Returns None if no args are given.
         '''
         if len(args) == 0:
             return None
-        rv = 0
+        key = None
+        types = tuple(map(type, args))
+        # containers compare equal when their contents' types differ (e.g. (1,) == (1.0,)),
+        # and so do 0.0 and -0.0, so only the seeds of simple args are memoised
+        if self._memoisable.issuperset(types):
+            key = (types, args)
+            rv = self._seeds.get(key)
+            if rv is not None:
+                return rv
         
+        encoded = []
         for arg in args:
-            unhashable = False
-            
-            try:
-                rv = rv ^ arg.__hash__() # XOR bitwise operation
-            except TypeError:
-                unhashable = True
-                
-            if unhashable:
-                # this means that the arg isn't hashable
-                try:
-                    rv = rv ^ str(arg).__hash__() # attemt to convert it into a string, then hash it
-                except:
-                    raise TypeError("Argument cannot be hashed or converted into a String")
+            self._encode(arg, encoded)
+        rv = struct.unpack('<Q', hashlib.sha1(''.join(encoded)).digest()[:8])[0]
+        
+        if key is not None:
+            if len(self._seeds) >= 10000:
+                self._seeds.clear() # keep the memo from growing without bound
+            self._seeds[key] = rv
         return rv
+
+    @classmethod
+    def _encode(cls, arg, out):
+        # append an unambiguous, type-tagged byte string representation of arg to the list out
+        if arg is None:
+            out.append('N')
+        elif arg is True or arg is False:
+            out.append('T' if arg else 'F')
+        elif isinstance(arg, (int, long)):
+            out.append('i%d;' % arg)
+        elif isinstance(arg, float):
+            out.append('f%r;' % arg)
+        elif isinstance(arg, str):
+            out.append('s%d:' % len(arg))
+            out.append(arg)
+        elif isinstance(arg, unicode):
+            arg = arg.encode('utf-8')
+            out.append('u%d:' % len(arg))
+            out.append(arg)
+        elif isinstance(arg, (list, tuple)):
+            out.append('%s%d[' % ('l' if isinstance(arg, list) else 't', len(arg)))
+            for item in arg:
+                cls._encode(item, out)
+            out.append(']')
+        elif isinstance(arg, (set, frozenset, dict)):
+            # these are unordered, so sort the encoded elements (or key/value pairs) first
+            items = []
+            for item in arg:
+                item_out = []
+                cls._encode(item, item_out)
+                if isinstance(arg, dict):
+                    cls._encode(arg[item], item_out)
+                items.append(''.join(item_out))
+            out.append('%s%d{' % ('d' if isinstance(arg, dict) else 'e', len(arg)))
+            out.extend(sorted(items))
+            out.append('}')
+        else:
+            try:
+                arg = str(arg) # attempt to convert it into a string, then hash that
+            except Exception:
+                raise TypeError("Argument cannot be hashed or converted into a String")
+            out.append('o%d:' % len(arg))
+            out.append(arg)
         
-    def get_seed():
-        return _seed
+    def get_seed(self):
+        return self._seed
+
+    def at(self, i):
+        '''
+        return the i-th value of a random sequence determined only by this instance's seed,
+        as a float in [0.0, 1.0). Unlike random(), this doesn't advance any state, and any
+        index can be looked up directly without generating the values before it.
+        (The sequence is the one the SplitMix64 generator would produce from the seed; see
+        Steele, Lea & Flood, "Fast Splittable Pseudorandom Number Generators" (2014).)
+        '''
+        if self._seed is None:
+            raise ValueError("at() requires a Pseudorandom created with a seed")
+        return (self._counter(i) >> 11) * 1.1102230246251565e-16 # 2 ** -53
+
+    def _counter(self, i):
+        # the i-th 64-bit output of SplitMix64 seeded with this instance's seed, computed directly
+        z = (self._seed + (i + 1) * 0x9e3779b97f4a7c15) & _MASK64
+        z = ((z ^ (z >> 30)) * 0xbf58476d1ce4e5b9) & _MASK64
+        z = ((z ^ (z >> 27)) * 0x94d049bb133111eb) & _MASK64
+        return z ^ (z >> 31)
+
+    def fork(self, i):
+        '''
+        return a new Pseudorandom whose seed is derived from this
+        instance's seed and i. Forking by item index lets item 5000 of a generated list be made
+        without generating the 4999 before it, and lets separate processes make different
+        parts of the same list.
+        '''
+        if self._seed is None:
+            raise ValueError("fork() requires a Pseudorandom created with a seed")
+        return Pseudorandom(self._seed, i)
 
     
     def choice(self, *elements):
@@ -82,6 +190,67 @@ class Pseudorandom(Random):
         else:
             return elements[self.randrange(0, len(elements))]
 
+    @classmethod
+    def _weighted(cls, elements, weights):
+        # return (elements, AliasTable) for the arguments of weighted_choice(), building tables only once
+        if weights is None:
+            # a dict of element -> weight; sorted, since dict order isn't the same in every process
+            elements, weights = zip(*sorted(elements.items())) if elements else ((), ())
+        if isinstance(weights, AliasTable):
+            table = weights
+        else:
+            key = tuple(weights)
+            table = cls._alias_tables.get(key)
+            if table is None:
+                if len(cls._alias_tables) >= 1000:
+                    cls._alias_tables.clear() # keep the cache from growing without bound
+                table = cls._alias_tables[key] = AliasTable(key)
+        if len(elements) != len(table):
+            raise ValueError("got %d elements but %d weights" % (len(elements), len(table)))
+        return elements, table
+
+    def weighted_choice(self, elements, weights = None):
+        '''
+        return one of elements, picked with probability proportional to its weight.
+        elements can also be a dict of element -> weight, in which case weights is left out.
+        The alias table for each set of weights is built once and cached, after which each pick
+        takes a single random() call no matter how many elements there are. For very long lists,
+        pass an AliasTable as weights to skip the cache lookup as well.
+        '''
+        elements, table = self._weighted(elements, weights)
+        return elements[table.pick(self.random())]
+
+    def weighted_choices(self, elements, weights = None, n = 1):
+        '''
+        return a list of n picks from elements; the same as calling weighted_choice() n times
+        '''
+        elements, table = self._weighted(elements, weights)
+        pick, random = table.pick, self.random
+        return [elements[pick(random())] for i in xrange(n)]
+
+    @classmethod
+    def _compile(cls, pattern):
+        '''
+        split a pattern in to a tuple of parts; runs of literal characters become a single string
+        and each replaced character becomes a (chars, len(chars)) tuple.
+        Patterns are only compiled once, and then cached.
+        '''
+        compiled = cls._patterns.get(pattern)
+        if compiled is None:
+            parts = []
+            for c in pattern:
+                chars = cls._chars.get(c)
+                if chars is not None:
+                    parts.append((chars, len(chars)))
+                elif parts and parts[-1].__class__ is not tuple:
+                    parts[-1] += c
+                else:
+                    parts.append(c)
+            if len(cls._patterns) >= 1000:
+                cls._patterns.clear() # keep the cache from growing without bound
+            compiled = cls._patterns[pattern] = tuple(parts)
+        return compiled
+
     def random_string(self, pattern):
         '''
         random_string takes a pattern and returns a generated string based on the pattern.
@@ -89,62 +258,931 @@ class Pseudorandom(Random):
         $ is replaced with an uppercase letter [A..Z]
         * is replaced with a random digit or uppercase letter [0..9, A..Z]
         '''
-        
-        chars = {"#": "0123456789",
-                 "$": "ABCDEFGHIJKLMNOPQRSTUVWXYZ",
-                 "*": "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-                }
-
-        rv = ''
-        for c in pattern:
-            if c in chars:
-                rv += self.choice(chars[c])
-            else:
-                rv += c
-        return rv
+        random = self.random
+        # int(random() * n) is what choice() does for us, minus the overhead of randrange()
+        return ''.join([part[0][int(random() * part[1])] if part.__class__ is tuple else part
+                        for part in self._compile(pattern)])
+
+    def random_strings(self, pattern, n):
+        '''
+        return a list of n strings generated from pattern. The result is the same as calling
+        random_string() n times, but the pattern is only looked up once.
+        '''
+        random = self.random
+        parts = self._compile(pattern)
+        return [''.join([part[0][int(random() * part[1])] if part.__class__ is tuple else part
+                         for part in parts])
+                for i in xrange(n)]
     
+    def _field(self, spec):
+        # turn a records() schema spec in to a function that takes a Pseudorandom and returns a value
+        if isinstance(spec, basestring):
+            field = lambda prnd: prnd.random_string(spec)
+        elif isinstance(spec, (list, tuple)):
+            size = len(spec)
+            field = lambda prnd: spec[int(prnd.random() * size)]
+        elif isinstance(spec, dict):
+            elements, table = self._weighted(spec, None)
+            field = lambda prnd: elements[table.pick(prnd.random())]
+        elif callable(spec):
+            field = spec
+        else:
+            field = lambda prnd: spec
+        return field
+
+    def records(self, schema, n, start = 0):
+        '''
+        Generate n records from schema, yielding each one as a dict as soon as it's made,
+        so that only one record is ever held in memory.
+        schema maps field names to specs, which can be
+         - a string: a pattern for random_string()
+         - a list or tuple: one of its elements is picked with choice()
+         - a dict: one of its keys is picked with weighted_choice()
+         - a callable: called with the record's Pseudorandom, which it can use to make a value
+         - anything else: used as it is
+        schema can be a dict, or a list of (name, spec) pairs to control the order fields are made in.
+        Record i is made from its own seed, the 64-bit value behind at(start + i), so
+        records(schema, 50, start = 5000) yields the same records as the last 50 of records(schema, 5050).
+        One Pseudorandom is reseeded for every record, rather than forking a new one (and hashing its seed).
+        '''
+        if isinstance(schema, dict) and not isinstance(schema, OrderedDict):
+            schema = sorted(schema.items()) # dict order isn't the same in every process
+        elif isinstance(schema, dict):
+            schema = schema.items()
+        fields = [(name, self._field(spec)) for name, spec in schema] # compiled once for every record
+        if self._seed is None:
+            raise ValueError("records() requires a Pseudorandom created with a seed")
+        prnd = Pseudorandom() # unseeded, so the memo isn't touched
+        for i in xrange(start, start + n):
+            prnd._reseed(self._counter(i))
+            record = {}
+            for name, field in fields:
+                record[name] = field(prnd)
+            yield record
+
     def random_line(self, filename):
         '''
-        return a pseudorandom line from the specified file
-        thanks to http://www.regexprn.com/2008/11/read-random-line-in-large-file-in.html
+        return a pseudorandom non-empty line from the specified file.
+        Every line is equally likely to be picked. The first time a file is used (and whenever it
+        changes), the offsets of its lines are indexed; after that picking a line only costs a stat().
         '''
-        file = open(filename,'r')
+        index = LineIndex.get(filename)
+        if len(index) == 0:
+            raise ValueError("'%s' has no non-empty lines" % filename)
+        return index.line(self.randrange(0, len(index)))
 
-        #Get the total file size
-        file_size = os.stat(filename)[6]
-        
-        while 1:
-            #Seek to a place in the file which is a random distance away
-            #Mod by file size so that it wraps around to the beginning
-            file.seek((file.tell() + self.randint(0, file_size - 1)) % file_size)
-        
-            #dont use the first readline since it may fall in the middle of a line
-            file.readline()
-            #this will return the next (complete) line from the file
-            line = file.readline().strip()
-            
-            if line != "":
-                return line
+    # fake data from the corpora bundled with cork. Each corpus is indexed (and memory-mapped) the
+    # first time it's used, so picking a value is a single draw and a slice of the map.
+
+    @classmethod
+    def load_corpora(cls):
+        '''index the bundled corpora now, so that processes forked afterwards share them'''
+        for name, filename in _corpora.iteritems():
+            cls._corpus_indexes[name] = LineIndex.get(filename)
+
+    def _corpus_line(self, name):
+        # like random_line(), but the bundled corpora don't change under us, so their indexes are
+        # kept here rather than checked against the disk every time
+        index = self._corpus_indexes.get(name)
+        if index is None:
+            index = self._corpus_indexes[name] = LineIndex.get(_corpora[name])
+        return index.line(self.randrange(0, len(index)))
+
+    def first_name(self):
+        return self._corpus_line("first_names")
+
+    def last_name(self):
+        return self._corpus_line("last_names")
+
+    def full_name(self):
+        return "%s %s" % (self.first_name(), self.last_name())
+
+    def email(self, first_name = None, last_name = None):
+        '''return an email address at one of the example domains, optionally built from a given name'''
+        return "%s.%s%s@%s" % ((first_name or self.first_name()).lower(),
+                               (last_name or self.last_name()).lower(),
+                               self.random_string("##"),
+                               self.choice(self._email_domains))
+
+    def street_address(self):
+        return "%d %s %s" % (self.randint(1, 9999), self._corpus_line("streets"),
+                             self.choice(self._street_suffixes))
+
+    def city(self):
+        return self._corpus_line("cities")
 
+    def company(self):
+        return "%s %s" % (self._corpus_line("companies"), self.choice(self._company_suffixes))
+
+class AliasTable(object):
+    '''
+    Walker's alias table for a list of weights, built with Vose's method. Once it's built,
+    picking an index with probability proportional to its weight takes constant time.
+    '''
+    def __init__(self, weights):
+        n = len(weights)
+        total = float(sum(weights))
+        if n == 0 or total <= 0 or min(weights) < 0:
+            raise ValueError("weights must be non-negative and add up to more than 0")
+        self.prob = [1.0] * n
+        self.alias = range(n)
+        scaled = [w * n / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = scaled[s], l
+            scaled[l] = (scaled[l] + scaled[s]) - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # whatever's left over is 1.0 give or take rounding errors, so it keeps prob 1.0
+
+    def __len__(self):
+        return len(self.prob)
+
+    def pick(self, r):
+        '''return an index, given a float r in [0.0, 1.0)'''
+        r *= len(self.prob)
+        i = int(r)
+        if r - i < self.prob[i]:
+            return i
+        return self.alias[i]
+
+class LineIndex(object):
+    '''
+    An index of where each non-empty line of a text file starts.
+    The file is memory-mapped rather than kept open, so indexing a file doesn't hold on
+    to a file descriptor, and processes forked after the index is built share its pages.
+    Like ReadCache, the index is checked against the file's mtime and size before it's used,
+    and rebuilt if the file has changed; reading a map of a file that has since been
+    truncated would kill the process.
+    '''
+    _indexes = {} # filename -> LineIndex, shared by every Pseudorandom instance
+
+    @classmethod
+    def get(cls, filename):
+        '''return the index for filename, building it the first time the file is used or after it changes'''
+        stats = os.stat(filename)
+        index = cls._indexes.get(filename)
+        if index is None or index.mtime != stats.st_mtime or index.size != stats.st_size:
+            index = cls._indexes[filename] = cls(filename)
+        return index
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.offsets = array('L')
+        file = open(filename, 'rb')
+        try:
+            stats = os.fstat(file.fileno())
+            self.mtime = stats.st_mtime
+            self.size = stats.st_size
+            offset = 0
+            for line in file:
+                if line.strip():
+                    self.offsets.append(offset)
+                offset += len(line)
+            if offset > 0:
+                self._map = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+            else:
+                self._map = None # empty files can't be mapped
+        finally:
+            file.close() # the map keeps its own reference to the file
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def line(self, i):
+        '''return the i-th non-empty line, with surrounding whitespace stripped'''
+        start = self.offsets[i]
+        end = self._map.find('\n', start)
+        if end < 0:
+            end = len(self._map)
+        return self._map[start:end].strip()
+
+
+class CannedFile(object):
+    '''
+    A file that has been read in to memory, along with the mtime and size
+    it had on disk at the time it was read.
+    '''
+    def __init__(self, filename, mtime, size, data):
+        self.filename = filename
+        self.mtime = mtime
+        self.size = size
+        self.data = data
+        self.variants = {} # content-coding -> compressed data, filled in by ReadCache.variant()
+        self._etag = None
+
+    def nbytes(self):
+        # the number of bytes this entry counts against the cache's budget
+        return len(self.data) + sum(len(v) for v in self.variants.itervalues())
+
+    def etag(self, encoding = None):
+        '''
+        return a strong entity tag for this file's data, hashing the data the first time it's needed.
+        Each content-coding gets its own tag, as required for strong validators.
+        '''
+        if self._etag is None:
+            self._etag = hashlib.sha1(self.data).hexdigest()
+        if encoding is None:
+            return '"%s"' % self._etag
+        return '"%s-%s"' % (self._etag, encoding)
+
+    def compress(self, encoding):
+        '''
+        return this file's data compressed with the given content-coding ('gzip' or 'deflate').
+        For gzip, an up to date sibling file with a .gz extension is used if there is one.
+        '''
+        if encoding == 'gzip':
+            try:
+                if os.stat(self.filename + '.gz').st_mtime >= self.mtime:
+                    file = open(self.filename + '.gz', 'rb')
+                    try:
+                        return file.read()
+                    finally:
+                        file.close()
+            except (OSError, IOError):
+                pass
+            buf = StringIO()
+            gz = gzip.GzipFile(filename = '', mode = 'wb', fileobj = buf, mtime = 0)
+            gz.write(self.data)
+            gz.close()
+            return buf.getvalue()
+        elif encoding == 'deflate':
+            return zlib.compress(self.data)
+        raise ValueError("unsupported content-coding: %s" % encoding)
+
+class ReadCache(object):
+    '''
+    ReadCache keeps the contents of recently read files in memory so that
+    repeated calls to read() don't go back to the disk.
+    Entries are checked against the file's mtime and size before being reused,
+    and the least recently used entries are evicted once the cache holds more
+    than max_bytes. A max_bytes of 0 disables caching.
+    Files loaded with preload() are kept in a separate index, which is
+    consulted before anything else and never checked against the disk.
+    They share max_bytes with the cache: the more that's preloaded, the less
+    room there is for everything else.
+    '''
+    def __init__(self, max_bytes = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # filename -> CannedFile, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.index = {} # path -> CannedFile, for preloaded files
+        self.preloaded_bytes = 0
+        self.preload_skipped = 0 # files preload() left on disk because they didn't fit in max_bytes
+        self._lock = threading.Lock()
+
+    def get(self, filename, stats = None):
+        '''
+        return the CannedFile for filename, reading it from disk if it isn't cached
+        or has changed since it was cached. Raises OSError/IOError if the file can't be read.
+        stats may be passed in if the caller has already stat()ed the file.
+        '''
+        if stats is None:
+            stats = os.stat(filename)
+        with self._lock:
+            entry = self.entries.pop(filename, None)
+            if entry is not None:
+                if entry.mtime == stats.st_mtime and entry.size == stats.st_size:
+                    self.entries[filename] = entry # re-insert as most recently used
+                    self.hits += 1
+                    return entry
+                self.size -= entry.nbytes()
+            self.misses += 1
+
+        file = open(filename, 'rb')
+        try:
+            data = file.read()
+        finally:
+            file.close()
+        entry = CannedFile(filename, stats.st_mtime, stats.st_size, data)
+        self.put(entry)
+        return entry
+
+    def put(self, entry):
+        # add an entry, evicting the least recently used ones until we're back under budget
+        nbytes = entry.nbytes()
+        with self._lock:
+            if nbytes > self.max_bytes - self.preloaded_bytes:
+                return
+            old = self.entries.pop(entry.filename, None)
+            if old is not None:
+                self.size -= old.nbytes()
+            self.entries[entry.filename] = entry
+            self.size += nbytes
+            self._evict()
+
+    def _evict(self):
+        # must be called with the lock held; preloaded files come out of the same budget
+        while self.size > self.max_bytes - self.preloaded_bytes and self.entries:
+            filename, evicted = self.entries.popitem(last = False)
+            self.size -= evicted.nbytes()
+            self.evictions += 1
+
+    def variant(self, entry, encoding):
+        '''
+        return entry's data compressed with encoding. Each variant is only compressed once,
+        and is kept alongside the raw data so that it counts against the cache's budget;
+        a variant that doesn't fit in the budget is returned without being kept.
+        '''
+        data = entry.variants.get(encoding)
+        if data is not None:
+            return data
+        data = entry.compress(encoding)
+        with self._lock:
+            if encoding in entry.variants:
+                return entry.variants[encoding] # another thread beat us to it
+            if self.index.get(entry.filename) is entry:
+                if self.preloaded_bytes + len(data) > self.max_bytes:
+                    return data
+                self.preloaded_bytes += len(data)
+            elif self.entries.get(entry.filename) is entry:
+                if self.preloaded_bytes + entry.nbytes() + len(data) > self.max_bytes:
+                    return data
+                self.size += len(data)
+            entry.variants[encoding] = data
+            self._evict()
+        return data
+
+    def preload(self, root):
+        '''
+        read every file under root in to the index. Each file is indexed by its absolute path
+        and by its path relative to the current working directory, so that read() can find it
+        without calling os.path.abspath(). Returns the number of files loaded.
+        Preloaded files are held to the same max_bytes budget as the cache: files that don't fit
+        are left on disk (and counted in preload_skipped), so that serve() still maps big ones
+        rather than sending them from memory.
+        '''
+        cwd = os.getcwd()
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            for name in sorted(filenames):
+                filename = os.path.abspath(os.path.join(dirpath, name))
+                old = self.index.get(filename)
+                room = self.max_bytes - self.preloaded_bytes + (old.nbytes() if old is not None else 0)
+                if os.path.getsize(filename) > room:
+                    self.preload_skipped += 1
+                    continue
+                file = open(filename, 'rb')
+                try:
+                    stats = os.fstat(file.fileno())
+                    data = file.read()
+                finally:
+                    file.close()
+                if old is not None:
+                    self.preloaded_bytes -= old.nbytes()
+                else:
+                    count += 1
+                entry = CannedFile(filename, stats.st_mtime, stats.st_size, data)
+                self.index[filename] = entry
+                self.index[os.path.relpath(filename, cwd)] = entry
+                with self._lock:
+                    self.preloaded_bytes += entry.nbytes()
+                    self._evict() # make room for it in the budget
+        return count
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.index.clear()
+            self.size = 0
+            self.preloaded_bytes = 0
+            self.preload_skipped = 0
+
+    def stats(self):
+        '''return a dict of the cache's counters'''
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "preloaded_bytes": self.preloaded_bytes}
+
+cache = ReadCache()
+
+def _canned(filename, mapped = False):
+    # look up the CannedFile for filename, raising a 404 if it doesn't exist.
+    # if mapped is set, files too big to be cached are returned as a MappedFile instead
+    entry = cache.index.get(filename) # preloaded files skip the filesystem entirely
+    if entry is None:
+        filename = os.path.abspath(filename)
+        entry = cache.index.get(filename)
+    debug("reading '%s':" % filename)
+    if entry is None:
+        try:
+            stats = os.stat(filename)
+            if mapped and stats.st_size > cache.max_bytes:
+                return MappedFile(filename)
+            entry = cache.get(filename, stats)
+        except (OSError, IOError):
+            log("file not found: %s" % filename)
+            raise HTTPError(404)
+    return entry
+
+def stream_json(records):
+    '''
+    Return a generator that encodes an iterable of records as a JSON array, one record at a time.
+    Returning it from a route streams the array to the client, e.g.
+    return stream_json(Pseudorandom(seed).records(schema, 100000))
+    '''
+    response.content_type = "application/json"
+    def body():
+        separator = '['
+        for record in records:
+            yield separator
+            yield json.dumps(record)
+            separator = ','
+        yield '[]' if separator == '[' else ']'
+    return body()
 
 def read(filename):
     '''
     Return a string containing the contents of
     a file relative to the calling function's file path
     '''
-    filename = os.path.abspath(filename)
-    debug("reading '%s':" % filename)
-    if os.path.exists(filename):
-        # open it, read it as a string and return the string
-        file = open(filename, 'r')
-        file_string = file.read()
-        file.close()
-        debug(file_string)
-        return(file_string)
+    file_string = _canned(filename).data
+    debug(file_string)
+    return(file_string)
+
+def _accepted_encoding(accept_encoding):
+    # pick the content-coding we'd most like to send from an Accept-Encoding header, or None for identity
+    accepted = {}
+    for coding in accept_encoding.split(','):
+        coding, _, params = coding.partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        accepted[coding] = q
+    for coding in ('gzip', 'deflate'):
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+def _if_none_match(entry):
+    # return the tag from the request's If-None-Match header that matches entry, or None
+    header = request.environ.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return None
+    current = entry.etag()[1:-1]
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag == '*':
+            return entry.etag()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        # any of the file's variants will do, since they all have the same content
+        if tag[1:-1] == current or tag[1:-1].startswith(current + '-'):
+            return tag
+    return None
+
+def _if_range(entry):
+    # return True if the request's Range header should be honoured, given its If-Range header
+    header = request.environ.get('HTTP_IF_RANGE', '').strip()
+    if not header:
+        return True
+    if header.startswith('"'):
+        return header == entry.etag() # If-Range requires a strong comparison
+    if header.startswith('W/'):
+        return False
+    date = parse_date(header)
+    return date is not None and date >= int(entry.mtime)
+
+def _parse_range(header, size):
+    '''
+    parse a Range header in to a list of (start, end) byte offsets, end exclusive.
+    Returns None if the header is malformed and should be ignored,
+    or an empty list if none of the ranges can be satisfied.
+    '''
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        first, sep, last = spec.strip().partition('-')
+        if not sep:
+            return None
+        try:
+            if first == '':
+                # a suffix range: the last n bytes of the file
+                start, end = max(0, size - int(last)), size
+            else:
+                start, end = int(first), size
+                if last != '':
+                    if int(last) < start:
+                        return None
+                    end = min(int(last) + 1, size)
+        except ValueError:
+            return None
+        if start < end:
+            ranges.append((start, end))
+    return ranges
+
+def _iter_range(source, start, end, chunk_size = 64 * 1024):
+    # yield source[start:end] a chunk at a time, so that large ranges are never copied in one go
+    for offset in xrange(start, end, chunk_size):
+        yield source[offset:min(offset + chunk_size, end)]
+
+def _range_response(source, ranges, header):
+    # build a 206 response holding the given ranges of source (a string or a MappedFile)
+    size = len(source)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        header['Content-Range'] = "bytes %d-%d/%d" % (start, end - 1, size)
+        header['Content-Length'] = end - start
+        if isinstance(source, MappedFile):
+            def body():
+                try:
+                    for chunk in _iter_range(source, start, end):
+                        yield chunk
+                finally:
+                    source.close()
+            return HTTPResponse(body(), status = 206, header = header)
+        return HTTPResponse(source[start:end], status = 206, header = header)
+
+    boundary = os.urandom(16).encode('hex')
+    content_type = header.get('Content-Type', 'application/octet-stream')
+    parts = []
+    length = len("--%s--\r\n" % boundary)
+    for start, end in ranges:
+        part = "--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n" \
+            % (boundary, content_type, start, end - 1, size)
+        parts.append((part, start, end))
+        length += len(part) + (end - start) + 2
+    def body():
+        try:
+            for part, start, end in parts:
+                yield part
+                for chunk in _iter_range(source, start, end):
+                    yield chunk
+                yield "\r\n"
+            yield "--%s--\r\n" % boundary
+        finally:
+            if isinstance(source, MappedFile):
+                source.close()
+    header['Content-Type'] = "multipart/byteranges; boundary=%s" % boundary
+    header['Content-Length'] = length
+    return HTTPResponse(body(), status = 206, header = header)
+
+def serve(filename, mimetype = 'auto'):
+    '''
+    Return an HTTPResponse with the contents of a canned file, in the spirit of bottle's static_file().
+    If the client's Accept-Encoding allows it, the body is sent gzip or deflate encoded;
+    compressed variants are made once per file and then kept in the read cache.
+    Responses carry an ETag, and a matching If-None-Match header gets a 304.
+    Range requests (including multiple ranges and If-Range) get a 206 with just the requested bytes.
+    Files too big for the read cache are memory-mapped, so only the bytes being sent are ever read.
+    '''
+    entry = _canned(filename, mapped = True)
+    header = {'Vary': 'Accept-Encoding',
+              'Accept-Ranges': 'bytes',
+              'Last-Modified': time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(entry.mtime))}
+    if isinstance(entry, MappedFile):
+        source = entry
     else:
+        source = entry.data
+
+    tag = _if_none_match(entry)
+    if tag is not None:
+        if source is entry:
+            entry.close()
+        header['ETag'] = tag
+        return HTTPResponse(status = 304, header = header)
+
+    if mimetype == 'auto':
+        mimetype = mimetypes.guess_type(entry.filename)[0]
+    if mimetype:
+        header['Content-Type'] = mimetype
+    header['ETag'] = entry.etag()
+
+    ranges = None
+    if 'HTTP_RANGE' in request.environ and _if_range(entry):
+        ranges = _parse_range(request.environ['HTTP_RANGE'], len(source))
+    if ranges == []:
+        if source is entry:
+            entry.close()
+        header['Content-Range'] = "bytes */%d" % len(source)
+        return HTTPResponse(status = 416, header = header)
+    if ranges:
+        return _range_response(source, ranges, header)
+
+    body = source
+    if source is not entry:
+        # only cached files are compressed; mapped files go out as they are
+        encoding = _accepted_encoding(request.environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is not None:
+            encoded = cache.variant(entry, encoding)
+            if len(encoded) < len(body): # don't bother if it doesn't make the body smaller
+                body = encoded
+                header['Content-Encoding'] = encoding
+                header['ETag'] = entry.etag(encoding)
+    header['Content-Length'] = len(body)
+    return HTTPResponse(body, header = header)
+
+class MappedFile(object):
+    '''
+    A read-only file-like view of a memory-mapped file.
+    Bottle hands anything with a read() method to the server's wsgi.file_wrapper,
+    so returning one of these from a route sends the file in chunks straight
+    from the page cache instead of building the whole body as a Python string.
+    fileno() is exposed so that servers which support sendfile can use it.
+    '''
+    def __init__(self, filename):
+        self.name = self.filename = filename
+        self._file = open(filename, 'rb')
+        stats = os.fstat(self._file.fileno())
+        self.size = stats.st_size
+        self.mtime = stats.st_mtime
+        self._pos = 0
+        if self.size > 0:
+            self._map = mmap.mmap(self._file.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self._map = None # empty files can't be mapped
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        # slices copy only the requested bytes
+        if self._map is None:
+            return ''[key]
+        return self._map[key]
+
+    def etag(self):
+        # mapped files are usually too big to hash on every request, so the tag comes from the stat info
+        return '"%x-%x"' % (int(self.mtime * 1000), self.size)
+
+    def fileno(self):
+        return self._file.fileno()
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self._pos + size, self.size)
+        data = self[self._pos:end]
+        self._pos = max(self._pos, end)
+        return data
+
+    def seek(self, offset, whence = 0):
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.size
+        self._pos = max(0, offset)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+def read_mapped(filename):
+    '''
+    Like read(), but returns a MappedFile instead of a string.
+    Return it from a route (or assign it to response.body) to send large canned files
+    without copying them in to memory; peak memory stays the same regardless of the file's size.
+    '''
+    filename = os.path.abspath(filename)
+    debug("mapping '%s'" % filename)
+    try:
+        mapped = MappedFile(filename)
+    except (OSError, IOError):
         log("file not found: %s" % filename)
         raise HTTPError(404)
-    
+    response['Content-Length'] = mapped.size
+    return mapped
+
+class _RouteNode(object):
+    # a node of TrieRouter's trie, for one segment of a path
+    __slots__ = ('static', 'wildcards', 'target', 'first')
+
+    def __init__(self, first):
+        self.static = {} # segment -> _RouteNode
+        self.wildcards = [] # (kind, key, match, _RouteNode), in the order they were added
+        self.target = None # (index, targets, params) of the first rule that ends here
+        self.first = first # the index of the first rule that goes through this node
+
+class TrieRouter(Router):
+    '''
+    A drop-in replacement for bottle's Router that finds the route for a path in time that grows
+    with the length of the path rather than the number of routes.
+    Rules are split on / into a trie of segments: plain text segments are looked up in a dict,
+    and wildcards that take up a whole segment (<name>, <name:int>, <name:float>, and <name:path>
+    at the end of a rule) are typed nodes tried one after another. Anything else (a wildcard
+    sharing its segment with text, a custom regular expression, a path in the middle of a rule)
+    is matched against the rest of the path by a regular expression, the way Router does.
+    Routes are matched in the same order as Router: the first route added that matches wins.
+    '''
+    # masks that can't match a /, so a wildcard using one can be matched a segment at a time
+    segment_masks = (Router.default_pattern, r'-?\d+', r'-?[\d.]+')
+    _segment, _rest, _tail = range(3) # the kinds of wildcard node
+
+    def __init__(self, strict = False):
+        Router.__init__(self, strict)
+        self._root = _RouteNode(0)
+
+    def add(self, rule, method, target, name = None):
+        # like Router.add(), but dynamic rules go in to the trie instead of a list of regular expressions
+        if rule in self.rules:
+            self.rules[rule][method] = target
+            if name:
+                self.builder[name] = self.builder[rule]
+            return
+        index = len(self.rules)
+        targets = self.rules[rule] = {method: target}
+        tokens = list(self.parse_rule(rule))
+        builder = []
+        anons = 0
+        for key, mode, conf in tokens:
+            if mode:
+                if not key:
+                    key = 'anon%d' % anons
+                    anons += 1
+                builder.append((key, self.filters[mode](conf)[2] or str))
+            elif key:
+                builder.append((None, key))
+        self.builder[rule] = builder
+        if name:
+            self.builder[name] = builder
+        if not any(mode for key, mode, conf in tokens) and not self.strict_order:
+            self.static[self.build(rule)] = targets
+            return
+        self._insert(rule, index, targets, tokens)
+
+    def _insert(self, rule, index, targets, tokens):
+        # split the rule in to segments, each a list of text and (name, mode, conf) wildcards
+        segments = [[]]
+        for key, mode, conf in tokens:
+            if mode:
+                segments[-1].append((key, mode, conf))
+            elif key:
+                parts = key.split('/')
+                segments[-1].append(parts[0])
+                segments.extend([part] for part in parts[1:])
+        node = self._root
+        params = [] # (name, filter) for each wildcard node on the way, or (None, filters) for a regular expression
+        for i, segment in enumerate(segments):
+            segment = [part for part in segment if part != '']
+            if all(isinstance(part, basestring) for part in segment):
+                text = ''.join(segment)
+                child = node.static.get(text)
+                if child is None:
+                    child = node.static[text] = _RouteNode(index)
+                node = child
+                continue
+            if len(segment) == 1:
+                name, mode, conf = segment[0]
+                mask, in_filter, out_filter = self.filters[mode](conf)
+                if mask in self.segment_masks:
+                    kind, key = self._segment, mask
+                    match = None if mask == self.default_pattern else re.compile('(?:%s)$' % mask).match
+                elif mode == 'path' and i == len(segments) - 1:
+                    kind, key, match = self._rest, None, None
+                else:
+                    kind = None
+                if kind is not None:
+                    node = self._wildcard(node, index, kind, key, match)
+                    params.append((name or '', in_filter))
+                    if kind == self._rest:
+                        break
+                    continue
+            # the rest of the rule is matched by a regular expression
+            pattern, tail_filters = self._pattern(segments[i:])
+            try:
+                match = re.compile('(?:%s)$' % pattern).match
+            except re.error, e:
+                raise RouteSyntaxError("Could not add Route: %s (%s)" % (rule, e))
+            node = self._wildcard(node, index, self._tail, pattern, match)
+            params.append((None, tail_filters))
+            break
+        if node.target is None:
+            node.target = (index, targets, params)
+
+    def _wildcard(self, node, index, kind, key, match):
+        # the child of node for a wildcard, added if it isn't there yet
+        for wildcard in node.wildcards:
+            if wildcard[:2] == (kind, key):
+                return wildcard[3]
+        child = _RouteNode(index)
+        node.wildcards.append((kind, key, match, child))
+        return child
+
+    def _pattern(self, segments):
+        # a regular expression for segments, built the same way Router.add() builds one for a whole rule
+        pattern = []
+        filters = []
+        for segment in segments:
+            part = ''
+            for token in segment:
+                if isinstance(token, basestring):
+                    part += re.escape(token)
+                    continue
+                name, mode, conf = token
+                mask, in_filter, out_filter = self.filters[mode](conf)
+                if name:
+                    part += '(?P<%s>%s)' % (name, mask)
+                    if in_filter:
+                        filters.append((name, in_filter))
+                else:
+                    part += '(?:%s)' % mask
+            pattern.append(part)
+        return '/'.join(pattern), filters
+
+    def _search(self, node, path, segments, i, offset, captures, best):
+        # depth first search for the earliest added rule that matches segments[i:], which start at
+        # path[offset:]; best is the earliest found so far, as (index, target, captures)
+        n = len(segments)
+        while i < n:
+            segment = segments[i]
+            child = node.static.get(segment)
+            if not node.wildcards:
+                # nothing to backtrack to, so just follow the text
+                if child is None or (best is not None and child.first >= best[0]):
+                    return best
+                node = child
+                offset += len(segment) + 1
+                i += 1
+                continue
+            if child is not None and (best is None or child.first < best[0]):
+                best = self._search(child, path, segments, i + 1, offset + len(segment) + 1, captures, best)
+            for kind, key, match, child in node.wildcards:
+                if best is not None and child.first >= best[0]:
+                    continue # only rules added later go this way
+                if kind == self._segment:
+                    if match(segment) if match is not None else segment:
+                        captures.append(segment)
+                        best = self._search(child, path, segments, i + 1, offset + len(segment) + 1, captures, best)
+                        captures.pop()
+                elif kind == self._rest:
+                    best = child.first, child.target, captures + [path[offset:]]
+                else:
+                    found = match(path, offset)
+                    if found:
+                        best = child.first, child.target, captures + [found.groupdict()]
+            return best
+        if node.target is not None and (best is None or node.target[0] < best[0]):
+            return node.target[0], node.target, list(captures)
+        return best
+
+    def match(self, environ):
+        ''' Return a (target, url_args) tuple or raise HTTPError(400/404/405), just like Router.match(). '''
+        path, targets, urlargs = environ['PATH_INFO'] or '/', None, {}
+        if path in self.static:
+            targets = self.static[path]
+        else:
+            found = self._search(self._root, path, path.split('/'), 0, 0, [], None)
+            if found is not None:
+                index, (index, targets, params), captures = found
+                try:
+                    for (name, in_filter), value in zip(params, captures):
+                        if name:
+                            urlargs[name] = in_filter(value) if in_filter is not None else value
+                        elif name is None:
+                            # the groups matched by a regular expression, and the filters for them
+                            for group, group_filter in in_filter:
+                                value[group] = group_filter(value[group])
+                            urlargs.update(value)
+                except ValueError:
+                    raise HTTPError(400, 'Path has wrong format.')
+
+        if not targets:
+            raise HTTPError(404, "Not found: " + repr(environ['PATH_INFO']))
+        method = environ['REQUEST_METHOD'].upper()
+        if method in targets:
+            return targets[method], urlargs
+        if method == 'HEAD' and 'GET' in targets:
+            return targets['GET'], urlargs
+        if 'ANY' in targets:
+            return targets['ANY'], urlargs
+        allowed = [verb for verb in targets if verb != 'ANY']
+        if 'GET' in allowed and 'HEAD' not in allowed:
+            allowed.append('HEAD')
+        raise HTTPError(405, "Method not allowed.", header = [('Allow', ",".join(allowed))])
+
+def use_trie_router(app = None):
+    '''
+    Switches app (bottle's default app if it's None) over to a TrieRouter, keeping the routes it already has,
+    and returns the router. Routes added afterwards go straight in to it.
+    '''
+    app = app if app is not None else default_app()
+    router = TrieRouter(app.router.strict_order)
+    for r in app.routes:
+        router.add(r.rule, r.method, r, name = r.name)
+    app.router = router
+    return router
+
 def log(message, tag = None):
     # log a message (and tag, if provided) if --verbosity is set
     global args
@@ -164,14 +1202,1428 @@ def debug(message, tag = None):
 def stop():
     # kill the current cork process
     print("Stopping...")
+    if state.default.journal is not None:
+        state.default.journal.close() # we won't get another chance to sync it
     os.kill(os.getpid(), signal.SIGKILL)
 
 def reset():
     debug('resetting  state')
-    state = {}
+    state.clear()
+
+class _StateLayer(object):
+    # one layer of a StateStore: key -> (value, expiry time or None, size) or _StateLayer.deleted,
+    # along with the keys that were given a ttl in this layer
+    __slots__ = ('entries', 'expiring')
+    deleted = object() # marks a key deleted in this layer that may still be set in the ones beneath it
+
+    def __init__(self, entries = None, expiring = None):
+        self.entries = entries if entries is not None else {}
+        self.expiring = expiring if expiring is not None else {}
+
+class StateStore(MutableMapping):
+    '''
+    StateStore is the dict behind cork.state and the /~cork api, made safe to share between
+    the threads (or greenlets) of a server.
+    Reads never take a lock; in CPython a single dict lookup is atomic, and iterating
+    works on a snapshot of the keys, so readers never see a half-made change or stall behind writers.
+    Writes are serialised per key by one of a fixed set of striped locks, so writers only
+    wait for each other when they're changing keys that share a stripe.
+    Every write gives its key a new version, which watch() can block on until the key changes.
+    
+    Keys set with a ttl expire lazily when they're next read, and periodically through sweep().
+    If max_entries or max_bytes is set, writes that go over budget evict the least recently
+    used keys, in batches down to 90% of the budget so the cost is shared between writes.
+    
+    The contents are kept in copy-on-write layers: writes only ever go to the top layer, and
+    checkpoint() freezes it and starts a new one on top, so restore() can go back to any
+    checkpoint by swapping the layers out, however many keys there are.
+    
+    If journal is set (see StateJournal), every change is recorded to it as it's made.
+    A replica (see StateLink) only changes through apply(): it hides keys whose ttl has run
+    out rather than dropping them, and leaves sweeping and eviction to the store it copies.
+    '''
+    max_layers = 8 # frozen layers beneath the top one before checkpoint() merges them
+    scan_chunk = 1000 # keys scan() copies out of the index each time it takes the lock
+
+    def __init__(self, stripes = 16, max_entries = None, max_bytes = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.journal = None
+        self.replica = False
+        self._layers = (_StateLayer(),) # the top layer first, then the frozen ones beneath it
+        self._locks = [threading.Lock() for i in range(stripes)]
+        self._versions = {} # key -> version of its last write, for keys written since the last clear() or restore()
+        self._epoch = 0 # the version every key is at, at least; moved on by clear() and restore()
+        self._counter = itertools.count(1) # next() is atomic in CPython
+        self._waiters = {} # key -> list of Events to set when it next changes
+        self._atime = {} # key -> tick of its last use, for LRU eviction
+        self._ticks = itertools.count()
+        self._untracked = False # set by restore(), whose keys aren't in _atime until the next eviction
+        self._evicting = threading.Lock()
+        self._index = None # every key in sorted order, built the first time someone scan()s
+        self._index_lock = threading.Lock()
+        self._checkpoints = {} # id -> (frozen layers, entries, bytes)
+        self._last_checkpoint = 0
+        # counters are kept per stripe so they're only ever changed under that stripe's lock
+        self._entries = [0] * stripes
+        self._bytes = [0] * stripes
+        self._evicted = [0] * stripes
+        self._expired = [0] * stripes
+
+    def _stripe(self, key):
+        return hash(key) % len(self._locks)
+
+    def _lock(self, key):
+        return self._locks[self._stripe(key)]
+
+    def _lock_all(self):
+        # take every stripe, always in the same order, so that nothing is half changed
+        for lock in self._locks:
+            lock.acquire()
+
+    def _unlock_all(self):
+        for lock in reversed(self._locks):
+            lock.release()
+
+    @staticmethod
+    def _sizeof(*objects):
+        # strings count as their length, which is what the budget is usually spent on
+        return sum(len(o) if isinstance(o, basestring) else sys.getsizeof(o) for o in objects)
+
+    def _entry(self, key):
+        # key's (value, expires, size) from the topmost layer that has it, or None
+        for layer in self._layers:
+            entry = layer.entries.get(key)
+            if entry is not None:
+                return None if entry is _StateLayer.deleted else entry
+        return None
+
+    @staticmethod
+    def _merge(layers):
+        # a dict of every key -> entry that's set through layers
+        if len(layers) == 1:
+            return layers[0].entries.copy()
+        merged = {}
+        for layer in reversed(layers):
+            merged.update(layer.entries)
+        return dict((k, e) for k, e in merged.iteritems() if e is not _StateLayer.deleted)
+
+    @staticmethod
+    def _due(entry):
+        # whether entry has a ttl that has run out
+        return entry is not None and entry[1] is not None and entry[1] <= time.time()
+
+    def _expire(self, key):
+        # drop key if its ttl has run out, returns True if it's gone
+        if not self._due(self._entry(key)):
+            return False
+        if self.replica:
+            return True
+        with self._lock(key):
+            if self._due(self._entry(key)):
+                self._discard(key, self._expired)
+            return self._entry(key) is None
+
+    def __getitem__(self, key):
+        entry = self._entry(key)
+        if entry is None or (entry[1] is not None and self._expire(key)):
+            raise KeyError(key)
+        if self.max_entries is not None or self.max_bytes is not None:
+            self._atime[key] = next(self._ticks)
+        return entry[0]
+
+    def get(self, key, default = None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        entry = self._entry(key)
+        return entry is not None and not (entry[1] is not None and self._expire(key))
+
+    def __len__(self):
+        return sum(self._entries) # includes expired keys that haven't been swept yet
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def _live(self):
+        # (key, entry) for every key that's set and hasn't expired
+        layers = self._layers
+        items = layers[0].entries.items() if len(layers) == 1 else self._merge(layers).items()
+        if any(layer.expiring for layer in layers):
+            now = time.time()
+            items = [(k, e) for k, e in items if e[1] is None or e[1] > now]
+        return items
+
+    def keys(self):
+        layers = self._layers
+        if len(layers) == 1 and not layers[0].expiring:
+            return layers[0].entries.keys() # a list, copied without releasing the GIL
+        return [k for k, e in self._live()]
+
+    def items(self):
+        return [(k, e[0]) for k, e in self._live()]
+
+    def values(self):
+        return [e[0] for k, e in self._live()]
+
+    def _changed(self, key, version = None):
+        # bump the key's version (or set it, for a replica) and wake anyone watching it; the key's lock must be held
+        self._versions[key] = version if version is not None else next(self._counter)
+        for event in self._waiters.pop(key, ()):
+            event.set()
+
+    def _wake_all(self, epoch = None):
+        # every key has changed; every stripe must be held
+        self._epoch = epoch if epoch is not None else next(self._counter)
+        waiters, self._waiters = self._waiters, {}
+        for events in waiters.values():
+            for event in events:
+                event.set()
+
+    def _discard(self, key, counter = None, version = None):
+        # remove key along with its bookkeeping; the key's lock must be held
+        entry = self._entry(key)
+        if entry is None:
+            raise KeyError(key)
+        i = self._stripe(key)
+        top = self._layers[0]
+        if len(self._layers) == 1:
+            del top.entries[key]
+        else:
+            top.entries[key] = _StateLayer.deleted
+        top.expiring.pop(key, None)
+        if self._index is not None:
+            with self._index_lock:
+                del self._index[bisect.bisect_left(self._index, key)]
+        self._entries[i] -= 1
+        self._bytes[i] -= entry[2]
+        self._atime.pop(key, None)
+        if counter is not None:
+            counter[i] += 1
+        self._changed(key, version)
+        # its watchers have been woken, so the key can go back to the version every unset key is at;
+        # otherwise every key ever deleted, expired or evicted would be remembered for good
+        del self._versions[key]
+        if self.journal is not None:
+            self.journal.record(('del', key))
+
+    def _put(self, key, value, expires, version = None):
+        # the body of set(); the key's lock must be held
+        i = self._stripe(key)
+        old = self._entry(key)
+        top = self._layers[0]
+        top.entries[key] = (value, expires, self._sizeof(key, value))
+        if expires is not None:
+            top.expiring[key] = True
+        else:
+            top.expiring.pop(key, None)
+        if old is None:
+            self._entries[i] += 1
+            if self._index is not None:
+                with self._index_lock:
+                    bisect.insort(self._index, key)
+        self._bytes[i] += top.entries[key][2] - (old[2] if old is not None else 0)
+        self._atime[key] = next(self._ticks)
+        self._changed(key, version)
+        if self.journal is not None:
+            self.journal.record(('set', key, value, expires))
+
+    def _current(self, key):
+        # key's entry, dropping it first if it has expired; the key's lock must be held
+        entry = self._entry(key)
+        if self._due(entry):
+            self._discard(key, self._expired)
+            return None
+        return entry
+
+    def set(self, key, value, ttl = None):
+        '''
+        Sets key to value, to expire after ttl seconds if given.
+        '''
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock(key):
+            self._put(key, value, expires)
+        if self._over_budget():
+            self._evict()
+
+    def compare_and_set(self, key, version, value, ttl = None):
+        '''
+        Sets key to value (as set() does) only if key is set and still at version, or, if version
+        is None, only if key isn't set at all. Returns whether it was set.
+        '''
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock(key):
+            entry = self._current(key)
+            if (entry is None) != (version is None) or (version is not None and self.version(key) != version):
+                return False
+            self._put(key, value, expires)
+        if self._over_budget():
+            self._evict()
+        return True
+
+    def incr(self, key, delta = 1, default = 0):
+        '''
+        Adds delta to the integer in key (default if it isn't set) and returns the result, atomically.
+        Integers kept as strings, as they are when they're set over HTTP, stay strings;
+        pass a default of '0' to start a counter off as a string.
+        Any ttl the key has is kept. Raises ValueError if key holds something other than an integer.
+        '''
+        with self._lock(key):
+            entry = self._current(key)
+            current = entry[0] if entry is not None else default
+            if isinstance(current, basestring):
+                try:
+                    value = str(int(current) + delta)
+                except ValueError:
+                    raise ValueError("%r is not an integer" % current)
+            elif isinstance(current, (int, long)) and not isinstance(current, bool):
+                value = current + delta
+            else:
+                raise ValueError("%r is not an integer" % current)
+            self._put(key, value, entry[1] if entry is not None else None)
+        if self._over_budget():
+            self._evict()
+        return value
+
+    def append(self, key, suffix):
+        '''
+        Adds suffix to the end of the string in key (or sets key to it, if it isn't set)
+        and returns the result, atomically. Any ttl the key has is kept.
+        Raises TypeError if key holds something other than a string.
+        '''
+        with self._lock(key):
+            entry = self._current(key)
+            if entry is not None and not isinstance(entry[0], basestring):
+                raise TypeError("%r is not a string" % entry[0])
+            value = entry[0] + suffix if entry is not None else suffix
+            self._put(key, value, entry[1] if entry is not None else None)
+        if self._over_budget():
+            self._evict()
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock(key):
+            if self._due(self._entry(key)):
+                self._discard(key, self._expired)
+            self._discard(key) # raises KeyError if it's not there
+
+    def setdefault(self, key, default = None):
+        with self._lock(key):
+            entry = self._entry(key)
+            if entry is not None and not self._due(entry):
+                return entry[0]
+        self.set(key, default)
+        return default
+
+    def pop(self, key, *default):
+        with self._lock(key):
+            entry = self._entry(key)
+            if self._due(entry):
+                self._discard(key, self._expired)
+                entry = None
+            if entry is None:
+                return {}.pop(key, *default)
+            self._discard(key)
+            return entry[0]
+
+    def _replace(self, layers, entries, nbytes, epoch = None):
+        # swap in a whole new set of layers; every stripe must be held
+        self._layers = layers
+        self._entries = [entries] + [0] * (len(self._locks) - 1)
+        self._bytes = [nbytes] + [0] * (len(self._locks) - 1)
+        self._wake_all(epoch)
+        self._versions = {} # every key is at the new epoch now
+
+    def clear(self, epoch = None):
+        self._lock_all()
+        try:
+            self._replace((_StateLayer(),), 0, 0, epoch)
+            self._atime = {}
+            self._untracked = False
+            if self._index is not None:
+                self._index = []
+            if self.journal is not None:
+                self.journal.record(('clear',))
+        finally:
+            self._unlock_all()
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "StateStore(%r)" % self.copy()
+
+    def checkpoint(self, id = None):
+        '''
+        Freezes everything in the store, and returns an id that restore() can roll back to.
+        Takes constant time, except that every max_layers checkpoints the frozen layers are merged.
+        A replica is given the id its original chose.
+        '''
+        self._lock_all()
+        try:
+            layers = self._layers
+            if not layers[0].entries and len(layers) > 1:
+                layers = layers[1:] # nothing has changed since the last checkpoint
+            if len(layers) > self.max_layers:
+                entries = self._merge(layers)
+                expiring = dict((k, True) for k, e in entries.iteritems() if e[1] is not None)
+                layers = (_StateLayer(entries, expiring),)
+            if id is None:
+                id = str(self._last_checkpoint + 1)
+            if id.isdigit():
+                self._last_checkpoint = max(self._last_checkpoint, int(id))
+            self._checkpoints[id] = (layers, sum(self._entries), sum(self._bytes))
+            self._layers = (_StateLayer(),) + layers
+            if self.journal is not None:
+                self.journal.record(('checkpoint', id))
+            return id
+        finally:
+            self._unlock_all()
+
+    def restore(self, id, epoch = None):
+        '''
+        Rolls the store back to how it was when checkpoint() returned id, in constant time.
+        The checkpoint is kept, so it can be restored again. Raises KeyError if there's no such checkpoint.
+        '''
+        layers, entries, nbytes = self._checkpoints[id]
+        self._lock_all()
+        try:
+            self._replace((_StateLayer(),) + layers, entries, nbytes, epoch)
+            self._index = None # rebuilt by the next scan()
+            self._untracked = True
+            if self.journal is not None:
+                self.journal.record(('restore', id))
+        finally:
+            self._unlock_all()
+
+    def drop(self, id):
+        '''
+        Forgets a checkpoint, so the memory only it was using can be freed.
+        Raises KeyError if there's no such checkpoint.
+        '''
+        self._lock_all()
+        try:
+            del self._checkpoints[id]
+            if self.journal is not None:
+                self.journal.record(('drop', id))
+        finally:
+            self._unlock_all()
+
+    def load_checkpoint(self, id, entries):
+        '''
+        Adds a checkpoint of entries, a dict of key -> (value, expiry time or None), under id.
+        StateJournal uses this to bring back the checkpoints that were saved with the store.
+        '''
+        entries = dict((k, (v, expires, self._sizeof(k, v))) for k, (v, expires) in entries.iteritems())
+        expiring = dict((k, True) for k, e in entries.iteritems() if e[1] is not None)
+        self._lock_all()
+        try:
+            self._checkpoints[id] = ((_StateLayer(entries, expiring),), len(entries), sum(e[2] for e in entries.itervalues()))
+            if id.isdigit():
+                self._last_checkpoint = max(self._last_checkpoint, int(id))
+        finally:
+            self._unlock_all()
+
+    def versions(self):
+        '''
+        Returns a dict of key -> version for every key that has changed since the store was
+        last cleared or restored, and the version of that clear or restore.
+        '''
+        return dict((k, v) for k, v in self._versions.items() if v > self._epoch), self._epoch
+
+    def apply(self, op, version = None):
+        '''
+        Makes a change recorded by another store's journal (see StateJournal.record), giving it
+        version, the version it had there. This is how a replica keeps up with its original.
+        '''
+        if op[0] == 'set':
+            with self._lock(op[1]):
+                self._put(op[1], op[2], op[3], version)
+        elif op[0] == 'del':
+            with self._lock(op[1]):
+                if self._entry(op[1]) is not None:
+                    self._discard(op[1], version = version)
+                elif version is not None:
+                    self._changed(op[1], version)
+        elif op[0] == 'clear':
+            self.clear(version)
+        elif op[0] == 'checkpoint':
+            self.checkpoint(op[1])
+        elif op[0] == 'restore':
+            self.restore(op[1], version)
+        elif op[0] == 'drop':
+            self.drop(op[1])
+
+    def sync(self, entries, checkpoints, versions, epoch):
+        '''
+        Makes a new store a replica of the one that entries, checkpoints (from its snapshot())
+        and versions and epoch (from its versions()) were taken from.
+        '''
+        self.replica = True
+        for id, saved in checkpoints.iteritems():
+            self.load_checkpoint(id, saved)
+        for key, (value, expires) in entries.iteritems():
+            self.apply(('set', key, value, expires), versions.get(key, epoch))
+        self._lock_all()
+        try:
+            self._versions.update(versions)
+            self._epoch = epoch
+        finally:
+            self._unlock_all()
+
+    def snapshot(self, then = None):
+        '''
+        Returns a dict of key -> (value, expiry time or None) for every key, and a dict of
+        checkpoint id -> a dict like the first for each checkpoint, taken while holding every
+        stripe so that no write is half made.
+        If then is given, it's called with both before the locks are released.
+        '''
+        def entries(layers):
+            return dict((k, e[:2]) for k, e in self._merge(layers).iteritems())
+        self._lock_all()
+        try:
+            current = entries(self._layers)
+            checkpoints = dict((id, entries(layers)) for id, (layers, n, b) in self._checkpoints.iteritems())
+            if then is not None:
+                then(current, checkpoints)
+            return current, checkpoints
+        finally:
+            self._unlock_all()
+
+    def scan(self, prefix = '', after = None, limit = None):
+        '''
+        Yields the keys that start with prefix, in sorted order, beginning with the first key
+        after after (to carry on from the end of a previous page) and stopping after limit of them.
+        The sorted index this uses is built the first time it's needed, and kept up to date from then on.
+        It's walked scan_chunk keys at a time, so writers are never held up for long by a big scan;
+        keys set or deleted while it's going may or may not be seen.
+        '''
+        n = 0
+        last = after if after is not None and (not prefix or after >= prefix) else None
+        while limit is None or n < limit:
+            if self._index is None:
+                # build it with every stripe held, so no new key can slip past it
+                self._lock_all()
+                try:
+                    if self._index is None:
+                        self._index = sorted(self._merge(self._layers))
+                finally:
+                    self._unlock_all()
+            with self._index_lock:
+                index = self._index or [] # thrown away by a restore() since we looked
+                if last is not None:
+                    i = bisect.bisect_right(index, last)
+                else:
+                    i = bisect.bisect_left(index, prefix) if prefix else 0
+                chunk = index[i:i + self.scan_chunk]
+            if not chunk:
+                return
+            for key in chunk:
+                if prefix and not (isinstance(key, basestring) and key.startswith(prefix)):
+                    return
+                entry = self._entry(key)
+                if entry is None or self._due(entry):
+                    continue # deleted since the chunk was copied, or expired
+                yield key
+                n += 1
+                if limit is not None and n >= limit:
+                    return
+            last = chunk[-1]
+
+    def version(self, key):
+        '''
+        Returns the version of key's last change. A key that isn't set is at the version of the
+        last clear() or restore(), or 0 if there hasn't been one.
+        '''
+        return max(self._versions.get(key, 0), self._epoch)
+
+    def watch(self, key, version, timeout = None):
+        '''
+        Blocks until key's version is no longer version, or until timeout seconds have passed,
+        and returns its current version.
+        Each watcher waits on its own Event, so under gevent's monkey patching a waiter
+        costs a greenlet rather than a thread.
+        '''
+        self._expire(key) # so a key that has run out counts as changed
+        with self._lock(key):
+            if self.version(key) != version:
+                return self.version(key)
+            event = threading.Event()
+            self._waiters.setdefault(key, []).append(event)
+        if not event.wait(timeout):
+            with self._lock(key):
+                events = self._waiters.get(key, [])
+                if event in events:
+                    events.remove(event)
+                    if not events:
+                        del self._waiters[key]
+        return self.version(key)
+
+    @property
+    def bytes(self):
+        return sum(self._bytes)
+
+    @property
+    def evictions(self):
+        return sum(self._evicted)
+
+    @property
+    def expirations(self):
+        return sum(self._expired)
+
+    def _over_budget(self):
+        if self.replica:
+            return False
+        return (self.max_entries is not None and len(self) > self.max_entries) or \
+               (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def _evict(self):
+        # drop the least recently used keys until we're under 90% of the budget
+        if not self._evicting.acquire(False):
+            return # another writer is already evicting
+        try:
+            self.sweep()
+            if not self._over_budget():
+                return
+            if self._untracked:
+                # keys brought back by restore() were last used before it, so they go before anything used since
+                self._untracked = False
+                for key in self.keys():
+                    self._atime.setdefault(key, -1)
+            entries_over = len(self) - int(self.max_entries * 0.9) if self.max_entries is not None else 0
+            bytes_over = self.bytes - int(self.max_bytes * 0.9) if self.max_bytes is not None else 0
+            while entries_over > 0 or bytes_over > 0:
+                # guess how many keys have to go from the average size, and find just those
+                n = max(entries_over, bytes_over * len(self) // max(self.bytes, 1) + 1)
+                victims = heapq.nsmallest(n, self._atime.items(), key = operator.itemgetter(1))
+                if not victims:
+                    break
+                for key, tick in victims:
+                    if entries_over <= 0 and bytes_over <= 0:
+                        break
+                    with self._lock(key):
+                        entry = self._entry(key)
+                        if entry is None:
+                            self._atime.pop(key, None) # rolled back by restore() since it was used
+                            continue
+                        entries_over -= 1
+                        bytes_over -= entry[2]
+                        self._discard(key, self._evicted)
+        finally:
+            self._evicting.release()
+
+    def sweep(self):
+        '''
+        Drops every key whose ttl has run out, and returns how many there were.
+        '''
+        if self.replica:
+            return 0
+        n = 0
+        keys = set()
+        for layer in self._layers:
+            keys.update(layer.expiring.keys())
+        for key in keys:
+            if self._due(self._entry(key)):
+                with self._lock(key):
+                    if self._due(self._entry(key)):
+                        self._discard(key, self._expired)
+                        n += 1
+        return n
+
+    def start_sweeper(self, interval = 1.0):
+        '''
+        Starts a daemon thread that calls sweep() every interval seconds.
+        '''
+        def sweeper():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+        thread = threading.Thread(target = sweeper, name = "cork-state-sweeper")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def stats(self):
+        '''return a dict of the store's size, budget and counters'''
+        return {"entries": len(self),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "expiring": len(set().union(*[layer.expiring for layer in self._layers])), # at most
+                "layers": len(self._layers),
+                "checkpoints": len(self._checkpoints),
+                "expirations": self.expirations,
+                "evictions": self.evictions}
+
+class StateJournal(object):
+    '''
+    StateJournal keeps a StateStore on disk, so its contents survive a restart.
+    Every change is appended to a log at <path>.log as it happens; compact() writes the whole
+    store, and its checkpoints, to a snapshot at <path> and starts a new log, so replaying at
+    startup only has to read one snapshot and the changes made since.
+    fsync sets how hard we try to keep the log on disk: 'always' syncs after every change,
+    'interval' syncs from a background thread every second (so at most about a second of
+    changes can be lost), and 'never' leaves it to the operating system.
+    '''
+    policies = ('always', 'interval', 'never')
+
+    def __init__(self, path, fsync = 'interval'):
+        if fsync not in self.policies:
+            raise ValueError("fsync must be one of %s (was '%s')" % (", ".join(self.policies), fsync))
+        self.path = path
+        self.fsync = fsync
+        self.log_path = path + ".log"
+        self.snapshot_bytes = 0
+        self._lock = threading.Lock()
+        self._log = None
+        self._dirty = False
+
+    def _open_log(self):
+        # the lock must be held (or the journal not in use yet)
+        self._log = open(self.log_path, 'ab')
+
+    def record(self, op):
+        '''
+        Appends op, a tuple of ('set', key, value, expires), ('del', key), ('clear',),
+        ('checkpoint', id), ('restore', id) or ('drop', id), to the log.
+        '''
+        try:
+            data = cPickle.dumps(op, 2)
+        except (cPickle.PicklingError, TypeError), e:
+            log("state for key %r can't be saved: %s" % (op[1], e), tag = "warning")
+            return
+        with self._lock:
+            if self._log is None:
+                return
+            self._log.write(data)
+            if self.fsync == 'always':
+                self._log.flush()
+                os.fsync(self._log.fileno())
+            else:
+                self._dirty = True
+
+    @staticmethod
+    def _replay(filename, entries, checkpoints):
+        # apply the ops logged in filename to entries and checkpoints, and return how many there were
+        if not os.path.exists(filename):
+            return 0
+        n = 0
+        with open(filename, 'rb') as f:
+            unpickler = cPickle.Unpickler(f)
+            while True:
+                offset = f.tell()
+                try:
+                    op = unpickler.load()
+                except EOFError:
+                    break
+                except Exception:
+                    # a change that was only partly written when we last stopped
+                    log("ignoring a damaged entry at byte %d of '%s'" % (offset, filename), tag = "warning")
+                    break
+                if op[0] == 'set':
+                    entries[op[1]] = (op[2], op[3])
+                elif op[0] == 'del':
+                    entries.pop(op[1], None)
+                elif op[0] == 'clear':
+                    entries.clear()
+                elif op[0] == 'checkpoint':
+                    checkpoints[op[1]] = entries.copy()
+                elif op[0] == 'restore':
+                    entries.clear()
+                    entries.update(checkpoints[op[1]])
+                elif op[0] == 'drop':
+                    checkpoints.pop(op[1], None)
+                n += 1
+        return n
+
+    def load(self, store):
+        '''
+        Reads the snapshot and replays the log in to store, then compacts them and starts
+        recording store's changes. Keys that expired while we were stopped are left out.
+        If store is already being shared, its changes are still sent out as well.
+        Returns the number of keys loaded.
+        '''
+        entries, checkpoints = {}, {}
+        self._replay(self.path, entries, checkpoints)
+        # a log left behind by a compaction that didn't finish comes before the current one
+        self._replay(self.log_path + ".old", entries, checkpoints)
+        self._replay(self.log_path, entries, checkpoints)
+        for id, saved in checkpoints.iteritems():
+            store.load_checkpoint(id, saved)
+        now = time.time()
+        for key, (value, expires) in entries.iteritems():
+            if expires is None:
+                store.set(key, value)
+            elif expires > now:
+                store.set(key, value, expires - now)
+        self.compact(store)
+        if isinstance(store.journal, _Replicator):
+            store.journal.journal = self
+        else:
+            store.journal = self
+        return len(store)
+
+    def compact(self, store):
+        '''
+        Writes everything in store to the snapshot and starts a new, empty log.
+        '''
+        def rotate(*snapshot):
+            # called with every stripe held, so no change can fall between the snapshot and the new log
+            with self._lock:
+                if self._log is not None:
+                    self._log.close()
+                if os.path.exists(self.log_path):
+                    os.rename(self.log_path, self.log_path + ".old")
+                self._open_log()
+                self._dirty = False
+        entries, checkpoints = store.snapshot(then = rotate)
+        
+        def write(f, entries, *ops):
+            # the snapshot is written as a log with one 'set' per key, so it's replayed the same way
+            f.write(cPickle.dumps(('clear',), 2))
+            for key, (value, expires) in entries.iteritems():
+                try:
+                    f.write(cPickle.dumps(('set', key, value, expires), 2))
+                except (cPickle.PicklingError, TypeError):
+                    pass # we warned about this when it was set
+            for op in ops:
+                f.write(cPickle.dumps(op, 2))
+        
+        temp = self.path + ".tmp"
+        with open(temp, 'wb') as f:
+            for id, saved in checkpoints.iteritems():
+                write(f, saved, ('checkpoint', id))
+            write(f, entries)
+            f.flush()
+            os.fsync(f.fileno())
+            self.snapshot_bytes = f.tell()
+        os.rename(temp, self.path)
+        if os.path.exists(self.log_path + ".old"):
+            os.remove(self.log_path + ".old")
+
+    def log_bytes(self):
+        with self._lock:
+            return self._log.tell() if self._log is not None else 0
+
+    def sync(self):
+        '''
+        Flushes the log and syncs it to disk, if anything has changed since the last sync.
+        '''
+        with self._lock:
+            if self._log is None or not self._dirty:
+                return
+            self._log.flush()
+            self._dirty = False
+            fileno = self._log.fileno()
+        if self.fsync != 'never':
+            # sync without the lock held, so changes can still be recorded while we wait on the disk
+            try:
+                os.fsync(fileno)
+            except OSError:
+                pass # the log was closed or rotated out from under us; compact() and close() sync it themselves
+
+    def start(self, store, interval = 1.0, min_compact_bytes = 1024 * 1024):
+        '''
+        Starts a daemon thread that syncs the log every interval seconds, and compacts it
+        once it's grown past both min_compact_bytes and the size of the last snapshot.
+        '''
+        def maintain():
+            while True:
+                time.sleep(interval)
+                self.sync()
+                if self.log_bytes() > max(min_compact_bytes, self.snapshot_bytes):
+                    self.compact(store)
+        thread = threading.Thread(target = maintain, name = "cork-state-journal")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+class StateSessions(MutableMapping):
+    '''
+    StateSessions is cork.state: a StateStore per session, so that many test runs can share
+    one cork process without seeing each other's state.
+    The session is named by the X-Cork-Session header (or the cork_session cookie) of the request
+    being handled, and its store is made the first time it's used. Requests that don't name one,
+    and code running outside of a request, use the default store.
+    Everything StateStore does can be done here, and is done to the current session's store.
+    
+    share() shares the sessions with other cork processes. One of them serves the state (see
+    StateServer) and the others keep replicas of it (see StateLink), which they read from directly
+    and send their changes through.
+    '''
+    header = 'HTTP_X_CORK_SESSION'
+    cookie = 'cork_session'
+    # the StateStore methods that change it, and have to be sent to the server by a linked process
+    changes = frozenset(['__setitem__', '__delitem__', 'set', 'compare_and_set', 'incr', 'append',
+                         'pop', 'setdefault', 'clear', 'checkpoint', 'restore', 'drop'])
+
+    def __init__(self, **options):
+        self.link = None # set first, as __getattr__ looks at it
+        self.server = None
+        self.options = options # passed to the StateStore of each new session
+        self.default = StateStore(**options)
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def current(self):
+        '''
+        Returns the name of the session the current request is in, or None.
+        '''
+        environ = getattr(request, 'environ', None) # unset outside of a request
+        if not environ:
+            return None
+        name = environ.get(self.header)
+        if name is None and 'HTTP_COOKIE' in environ:
+            name = request.get_cookie(self.cookie)
+        return name or None
+
+    def session(self, name = None):
+        '''
+        Returns the StateStore for the session called name, or for the current session if name is None.
+        '''
+        if (self.link is not None or self.server is not None) and self._pid != os.getpid():
+            self._forked()
+        if name is None:
+            name = self.current()
+            if name is None:
+                return self.default
+        store = self._sessions.get(name)
+        if store is None:
+            with self._lock:
+                store = self._sessions.get(name)
+                if store is None:
+                    store = self._sessions[name] = StateStore(**self.options)
+                    store.replica = self.link is not None
+                    if self.server is not None:
+                        self.server.attach(name, store)
+        return store
+
+    def share(self, path):
+        '''
+        Shares the sessions with every other cork process that calls this with the same path.
+        The first to do so serves the state on a unix socket at path, and returns True;
+        the rest link to it, and return False. Raises ValueError if path is something other than
+        a socket, or is a socket run by another user.
+        '''
+        server = StateServer(self, path)
+        if server.start():
+            return True
+        self.link = StateLink(self, path)
+        self.link.start()
+        return False
+
+    def _forked(self):
+        # we're a new process, forked from one that was sharing its state, so link to the same server
+        path = (self.link or self.server).path
+        self._lock = threading.Lock() # the old one may have been held by a thread that didn't come with us
+        self.link = self.server = None
+        self._pid = os.getpid()
+        self.link = StateLink(self, path)
+        self.link.start()
+
+    def _call(self, method, *args, **kwargs):
+        # make a change to the current session, through the server if we're linked to one
+        store = self.session() # first, so a forked process links itself
+        if self.link is not None:
+            return self.link.call(self.current(), method, args, kwargs)
+        return getattr(store, method)(*args, **kwargs)
+
+    def sessions(self):
+        '''
+        Returns a dict of the name of every session -> the number of keys in it.
+        '''
+        return dict((name, len(store)) for name, store in self._sessions.items())
+
+    def end(self, name = None):
+        '''
+        Throws away a session (the current one if name is None) and everything in it, all at once.
+        Returns False if there was no such session.
+        '''
+        name = name if name is not None else self.current()
+        self.session(None) # so a forked process links itself
+        if self.link is not None:
+            return self.link.call(name, 'end', (), {})
+        with self._lock:
+            store = self._sessions.pop(name, None)
+        if store is None:
+            return False
+        store.clear() # wakes anyone still watching it
+        if self.server is not None:
+            self.server.publish(name, ('end',))
+        return True
+
+    def configure(self, **options):
+        '''
+        Sets StateStore options, such as max_entries and max_bytes, on every store, now and to come.
+        '''
+        self.options.update(options)
+        for store in [self.default] + self._sessions.values():
+            for k, v in options.iteritems():
+                setattr(store, k, v)
+
+    def sweep(self):
+        '''
+        Sweeps every session's store, and returns how many keys had expired.
+        '''
+        return sum(store.sweep() for store in [self.default] + self._sessions.values())
+
+    def start_sweeper(self, interval = 1.0):
+        '''
+        Starts a daemon thread that sweeps every session every interval seconds.
+        '''
+        def sweeper():
+            while True:
+                time.sleep(interval)
+                self.sweep()
+        thread = threading.Thread(target = sweeper, name = "cork-state-sweeper")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def __getattr__(self, name):
+        # everything else belongs to the current session's store
+        if self.link is not None and name in self.changes:
+            return lambda *args, **kwargs: self._call(name, *args, **kwargs)
+        return getattr(self.session(), name)
+
+    def __getitem__(self, key):
+        return self.session()[key]
+
+    def __setitem__(self, key, value):
+        self._call('__setitem__', key, value)
+
+    def __delitem__(self, key):
+        self._call('__delitem__', key)
+
+    def __contains__(self, key):
+        return key in self.session()
+
+    def __len__(self):
+        return len(self.session())
+
+    def __iter__(self):
+        return iter(self.session())
+
+    def get(self, key, default = None):
+        return self.session().get(key, default)
+
+    def keys(self):
+        return self.session().keys()
+
+    def items(self):
+        return self.session().items()
+
+    def values(self):
+        return self.session().values()
+
+    def pop(self, key, *default):
+        return self._call('pop', key, *default)
+
+    def setdefault(self, key, default = None):
+        return self._call('setdefault', key, default)
+
+    def clear(self):
+        self._call('clear')
+
+    def copy(self):
+        return self.session().copy()
+
+    def __repr__(self):
+        return "StateSessions(%r)" % self.copy()
+
+def _send_message(sock, message):
+    # messages between StateServer and StateLink are pickled, with their length in front
+    data = cPickle.dumps(message, 2)
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+def _recv_exactly(sock, n):
+    data = ''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise EOFError("state socket closed")
+        data += chunk
+    return data
+
+def _check_peer(sock):
+    # pickles are only ever exchanged with processes run by the same user
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        if uid != os.getuid():
+            raise ValueError("the other end of the state socket is run by another user (uid %d)" % uid)
+
+def _check_socket(path):
+    # make sure path is a socket we made, before connecting to it or replacing it
+    stats = os.lstat(path)
+    if not stat.S_ISSOCK(stats.st_mode):
+        raise ValueError("'%s' exists and isn't a socket" % path)
+    if stats.st_uid != os.getuid():
+        raise ValueError("the socket '%s' belongs to another user (uid %d)" % (path, stats.st_uid))
+
+def _recv_message(sock):
+    n, = struct.unpack('!I', _recv_exactly(sock, 4))
+    return cPickle.loads(_recv_exactly(sock, n))
+
+class _Replicator(object):
+    # stands in as the journal of a store that StateServer is sharing, and sends out its changes
+    # (passing them on to the store's own journal, if it had one)
+    def __init__(self, server, name, store):
+        self.server = server
+        self.name = name
+        self.store = store
+        self.journal = store.journal
+
+    def record(self, op):
+        if self.journal is not None:
+            self.journal.record(op)
+        # the store's locks are still held, so this is the version the change was given
+        if op[0] in ('set', 'del'):
+            version = self.store.version(op[1])
+        elif op[0] in ('clear', 'restore'):
+            version = self.store._epoch
+        else:
+            version = None
+        self.server.publish(self.name, op, version)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+
+class StateServer(object):
+    '''
+    StateServer shares a StateSessions with other cork processes through a unix socket.
+    The process that runs it keeps using its state directly. The others connect with a StateLink:
+    each change made here is sent to them as it happens, to keep their replicas up to date,
+    and their changes are sent here to be made.
+    Messages are pickled, so the socket is only made accessible to the user running cork.
+    '''
+    def __init__(self, sessions, path):
+        self.sessions = sessions
+        self.path = path
+        self.seq = 0 # the number of changes sent out
+        self._lock = threading.Lock()
+        self._subscribers = [] # (queue of messages, names of the sessions it has been sent)
+
+    @staticmethod
+    def running(path):
+        '''
+        Returns whether a StateServer is listening at path.
+        '''
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+            return True
+        except socket.error:
+            return False
+        finally:
+            sock.close()
+
+    def start(self):
+        '''
+        Starts serving on a daemon thread, and returns True, unless another server is already
+        listening at path, in which case it returns False.
+        Raises ValueError if path is something other than a socket, or belongs to another user.
+        '''
+        if os.path.lexists(self.path):
+            _check_socket(self.path)
+            if self.running(self.path):
+                return False
+            os.remove(self.path) # left behind by a server that didn't shut down cleanly
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(077) # so nobody else can connect, even before the chmod
+        try:
+            sock.bind(self.path)
+        except socket.error:
+            sock.close()
+            _check_socket(self.path)
+            return False # another process got there first
+        finally:
+            os.umask(umask)
+        os.chmod(self.path, 0600)
+        sock.listen(128)
+        with self.sessions._lock:
+            self.sessions.server = self
+            self.attach(None, self.sessions.default)
+            for name, store in self.sessions._sessions.items():
+                self.attach(name, store)
+        thread = threading.Thread(target = self._accept, args = (sock,), name = "cork-state-server")
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def attach(self, name, store):
+        '''
+        Starts sending out the changes made to store, as the session called name.
+        '''
+        store.journal = _Replicator(self, name, store)
+        with self._lock:
+            for queue, synced in self._subscribers:
+                synced.add(name) # a new session starts out empty everywhere
+
+    def publish(self, name, op, version = None):
+        '''
+        Sends a change made to session name to every linked process.
+        '''
+        with self._lock:
+            self.seq += 1
+            for queue, synced in self._subscribers:
+                if name in synced:
+                    queue.put(('op', self.seq, name, op, version))
+
+    def _accept(self, sock):
+        while True:
+            conn, address = sock.accept()
+            thread = threading.Thread(target = self._serve, args = (conn,), name = "cork-state-connection")
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, conn):
+        try:
+            _check_peer(conn)
+            if _recv_message(conn) == ('subscribe',):
+                self._subscribe(conn)
+            else:
+                self._answer(conn)
+        except (EOFError, socket.error):
+            pass # the other process went away
+        except ValueError, e:
+            log("refused a state connection: %s" % e, tag = "warning")
+        finally:
+            conn.close()
+
+    def _answer(self, conn):
+        # make the changes a linked process asks for, and tell it how far along the changes
+        # it has to have seen before it can read them back
+        while True:
+            name, method, args, kwargs = _recv_message(conn)
+            try:
+                if method == 'end':
+                    result = self.sessions.end(name)
+                else:
+                    store = self.sessions.default if name is None else self.sessions.session(name)
+                    result = getattr(store, method)(*args, **kwargs)
+                reply = ('ok', result)
+            except Exception, e:
+                reply = ('error', e)
+            _send_message(conn, reply + (self.seq,))
+
+    def _subscribe(self, conn):
+        # send a copy of every session, then every change made from that moment on
+        queue = Queue.Queue()
+        synced = set()
+        def sync(name, store):
+            def send(entries, checkpoints):
+                # every stripe of the store is held, so nothing can change before we're subscribed to it
+                versions, epoch = store.versions()
+                with self._lock:
+                    synced.add(name)
+                    queue.put(('sync', name, entries, checkpoints, versions, epoch))
+            store.snapshot(then = send)
+        with self.sessions._lock:
+            with self._lock:
+                self._subscribers.append((queue, synced))
+            sync(None, self.sessions.default)
+            for name, store in self.sessions._sessions.items():
+                sync(name, store)
+            with self._lock:
+                queue.put(('ready', self.seq))
+        try:
+            while True:
+                message = queue.get()
+                try:
+                    _send_message(conn, message)
+                except (cPickle.PicklingError, TypeError), e:
+                    log("a change to state can't be shared: %s" % e, tag = "warning")
+        finally:
+            with self._lock:
+                self._subscribers.remove((queue, synced))
+
+class StateLink(object):
+    '''
+    StateLink keeps a StateSessions in step with one served by a StateServer in another process.
+    Every session is a replica that's read from directly, so reads never wait on the server;
+    changes are sent to the server to be made, and only return once the replica has caught up
+    with them, so a process always reads back its own changes.
+    '''
+    timeout = 5.0 # seconds to wait for the replica to catch up with a change
+
+    def __init__(self, sessions, path):
+        self.sessions = sessions
+        self.path = path
+        self.seq = 0 # the last change made to the replicas
+        self._caught_up = threading.Condition()
+        self._connections = threading.local()
+
+    def _connect(self, first):
+        # raises ValueError if the socket isn't one that another cork run by this user is serving
+        _check_socket(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            _check_peer(sock)
+        except:
+            sock.close()
+            raise
+        _send_message(sock, first)
+        return sock
+
+    def start(self):
+        '''
+        Copies every session from the server, and keeps them up to date from a daemon thread.
+        '''
+        sock = self._connect(('subscribe',))
+        while True:
+            message = _recv_message(sock)
+            self._handle(message)
+            if message[0] == 'ready':
+                break
+        thread = threading.Thread(target = self._listen, args = (sock,), name = "cork-state-link")
+        thread.daemon = True
+        thread.start()
+
+    def _listen(self, sock):
+        try:
+            while True:
+                self._handle(_recv_message(sock))
+        except (EOFError, socket.error):
+            log("lost the connection to the state server at '%s'" % self.path, tag = "warning")
+
+    def _handle(self, message):
+        sessions = self.sessions
+        if message[0] == 'sync':
+            name, entries, checkpoints, versions, epoch = message[1:]
+            store = StateStore(**sessions.options)
+            store.sync(entries, checkpoints, versions, epoch)
+            with sessions._lock:
+                if name is None:
+                    sessions.default = store
+                else:
+                    sessions._sessions[name] = store
+            return
+        seq = message[1]
+        if message[0] == 'op':
+            name, op, version = message[2:]
+            if op[0] == 'end':
+                with sessions._lock:
+                    store = sessions._sessions.pop(name, None)
+                if store is not None:
+                    store.clear()
+            else:
+                (sessions.default if name is None else sessions.session(name)).apply(op, version)
+        with self._caught_up:
+            self.seq = seq
+            self._caught_up.notify_all()
+
+    def call(self, name, method, args, kwargs):
+        '''
+        Calls method on the server's store for session name, and returns what it returns.
+        '''
+        sock = getattr(self._connections, 'sock', None)
+        if sock is None:
+            sock = self._connections.sock = self._connect(('call',))
+        try:
+            _send_message(sock, (name, method, args, kwargs))
+            status, result, seq = _recv_message(sock)
+        except (EOFError, socket.error):
+            self._connections.sock = None
+            raise
+        with self._caught_up:
+            deadline = time.time() + self.timeout
+            while self.seq < seq and time.time() < deadline:
+                self._caught_up.wait(deadline - time.time())
+        if status == 'error':
+            raise result
+        return result
 
 # set up state handlers
-state = {}
+state = StateSessions()
+
+def _ttl():
+    # the ttl in seconds given by ?ttl= or an X-Cork-TTL header, or None if there isn't one
+    ttl = request.query.get('ttl') or request.headers.get('X-Cork-TTL')
+    if ttl is None:
+        return None
+    try:
+        ttl = float(ttl)
+    except ValueError:
+        raise HTTPError(400, "ttl must be a number of seconds")
+    if ttl <= 0:
+        raise HTTPError(400, "ttl must be positive")
+    return ttl
+
+def _bulk_values():
+    # parse the body of a bulk POST, either a JSON object or form data, in to a dict of key -> value
+    if request.content_type.startswith('application/json'):
+        try:
+            data = json.loads(request.body.read())
+        except ValueError:
+            raise HTTPError(400, "request body is not valid JSON")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "expected a JSON object of key/value pairs")
+        values = {}
+        for k, v in data.iteritems():
+            if isinstance(v, unicode):
+                v = v.encode('utf-8')
+            elif not isinstance(v, str):
+                v = json.dumps(v) # state values are always strings
+            values[k.encode('utf-8')] = v
+        return values
+    return dict(request.forms.items())
+
+def _versions(header):
+    # the versions listed in an If-Match or If-None-Match header, with '*' left as it is
+    versions = set()
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        tag = tag.strip('"')
+        if tag == '*':
+            versions.add(tag)
+        elif tag.isdigit():
+            versions.add(int(tag))
+    return versions
+
+def _version_headers(key):
+    # tell the client which version of key it's getting, and return it
+    version = state.version(key)
+    response.headers['X-Cork-Version'] = str(version)
+    response.headers['ETag'] = '"%d"' % version
+    return version
+
+def _text(value):
+    # a value as it's sent over HTTP: strings as they are, anything else set from service code as str() shows it
+    return value if isinstance(value, basestring) else str(value)
+
+def _dump(keys):
+    # yield key=value lines for each of keys that's still set, without a newline after the last
+    missing = object()
+    separator = ''
+    for k in keys:
+        value = state.get(k, missing)
+        if value is missing:
+            continue # deleted since we listed it
+        line = "%s%s=%s" % (separator, k, value)
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        yield line
+        separator = "\n"
+
 @route('/~cork')
 @route('/~cork/<path:path>', method = ['GET', 'POST'])
 def _state_handler(path = ''):
@@ -186,26 +2638,128 @@ def _state_handler(path = ''):
         elif path == 'reset':
             reset()
             raise HTTPError(200, "state reset")
+        elif path == 'end':
+            # throw away the whole of the request's session
+            if state.current() is None:
+                raise HTTPError(400, "no session to end; name one with an X-Cork-Session header")
+            state.end()
+            raise HTTPError(200, "session ended")
+        elif path == 'checkpoint':
+            id = state.checkpoint()
+            debug("state checkpoint %s" % id)
+            return {"id": id}
+        elif path.startswith('restore/') or path.startswith('drop/'):
+            command, id = path.split('/', 1)
+            try:
+                getattr(state, command)(id)
+            except KeyError:
+                raise HTTPError(404, "no state checkpoint '%s'" % id)
+            debug("state checkpoint %s: %s" % (id, command))
+            raise HTTPError(200, "%s %s" % (command, id))
+        elif path == 'bulk':
+            values = _bulk_values()
+            ttl = _ttl()
+            debug("recieved new state data for %d keys" % len(values))
+            for k, v in values.iteritems():
+                state.set(k, v, ttl)
+            return {"count": len(values)}
             
         body = request.body.read()
         debug("recieved new state data: %s=%s" % (path, body))
-        state[path] = body
+        op = request.query.get('op')
+        if op is not None:
+            # atomic read-modify-write operations
+            try:
+                if op == 'incr':
+                    try:
+                        delta = int(body) if body.strip() else 1
+                    except ValueError:
+                        raise HTTPError(400, "the amount to incr by must be an integer")
+                    value = state.incr(path, delta, default = '0') # values set over HTTP are strings
+                elif op == 'append':
+                    value = state.append(path, body)
+                else:
+                    raise HTTPError(400, "unknown op '%s' (choose from: incr, append)" % op)
+            except (ValueError, TypeError), e:
+                raise HTTPError(409, str(e))
+            _version_headers(path)
+            response.content_type = "text/plain"
+            return _text(value)
+        if 'If-Match' in request.headers or 'If-None-Match' in request.headers:
+            # compare-and-swap: only set the key if nobody else has changed it since the client read it
+            ttl = _ttl()
+            if 'If-Match' in request.headers:
+                versions = _versions(request.headers['If-Match'])
+                if '*' in versions:
+                    versions = [state.version(path)] # any version, as long as it's set
+                ok = any(state.compare_and_set(path, version, body, ttl) for version in versions)
+            else:
+                versions = _versions(request.headers['If-None-Match'])
+                while True:
+                    # any version but the listed ones will do, so swap against whichever is current
+                    version = state.version(path) if path in state else None
+                    if version in versions or ('*' in versions and version is not None):
+                        ok = False
+                        break
+                    ok = state.compare_and_set(path, version, body, ttl)
+                    if ok:
+                        break
+            if not ok:
+                _version_headers(path)
+                raise HTTPError(412, "%s has changed" % path)
+        else:
+            state.set(path, body, _ttl())
+        _version_headers(path)
         return HTTPError(200, "%s=%s" % (path, body))
         
     elif request.method == 'GET':
         if path == '':
-            body = ''
-            if len(state) == 0:
-                print("derp")
-                response.body = ''
-            else:
-                
-                for k in state.keys():
-                    print("herp")
-                    body += "%s=%s\n" % (k, state.get(k, ''))
-                response.body = body[:-1] # trim the last newline
+            # stream every key (or a page of those starting with ?prefix=) in sorted order
+            try:
+                limit = int(request.query.limit) if request.query.limit else None
+            except ValueError:
+                raise HTTPError(400, "limit must be a number")
+            if limit is not None and limit < 1:
+                raise HTTPError(400, "limit must be positive")
+            keys = state.scan(request.query.prefix, request.query.get('after'))
+            if limit is not None:
+                # read one more than we need to know whether there's another page
+                keys = list(itertools.islice(keys, limit + 1))
+                if len(keys) > limit:
+                    # there's more; the next page starts after the last key of this one
+                    keys = keys[:limit]
+                    response.headers['X-Cork-Next'] = str(keys[-1])
+            response.content_type = "text/plain"
+            return _dump(keys)
+        elif path == 'stats':
+            return state.stats()
+        elif path == 'sessions':
+            return state.sessions()
+        elif path == 'bulk':
+            # a JSON object of the keys given with ?key=..., or of every key if none are given;
+            # values are strings, as they are everywhere else in the api, and missing keys are null
+            keys = request.query.getall('key') or state.keys()
+            missing = object()
+            values = {}
+            for k in keys:
+                value = state.get(k, missing)
+                values[_text(k)] = _text(value) if value is not missing else None
+            return values
         else:
-            response.body = state.get(path, '')
+            if 'wait' in request.query:
+                # long-poll until the key's version moves on from the one given
+                try:
+                    version = int(request.query.wait)
+                    timeout = min(float(request.query.get('timeout', 30)), 300)
+                except ValueError:
+                    raise HTTPError(400, "wait and timeout must be numbers")
+                if state.watch(path, version, timeout) == version:
+                    response.status = 304 # timed out without a change
+            version = _version_headers(path)
+            versions = _versions(request.headers.get('If-None-Match', ''))
+            if 'wait' not in request.query and (version in versions or ('*' in versions and path in state)):
+                response.status = 304 # the client already has this version
+            response.body = _text(state.get(path, ''))
         
         debug("queried state:\n'%s'" % response.body)
         
@@ -220,8 +2774,20 @@ if __name__ == '__main__':
     # we'll create a virtual module and add it to the main namespace
     cork = types.ModuleType('cork')
     cork.Pseudorandom = Pseudorandom
+    cork.AliasTable = AliasTable
     cork.state = state
+    cork.StateStore = StateStore
+    cork.StateJournal = StateJournal
+    cork.StateServer = StateServer
+    cork.StateLink = StateLink
+    cork.StateSessions = StateSessions
+    cork.TrieRouter = TrieRouter
+    cork.use_trie_router = use_trie_router
     cork.read = read
+    cork.read_mapped = read_mapped
+    cork.serve = serve
+    cork.stream_json = stream_json
+    cork.cache = cache
     cork.log = log
     cork.stop = stop
     cork.reset = reset
@@ -240,53 +2806,93 @@ if __name__ == '__main__':
     parser.add_argument("--host", default = "localhost", help = "Server address to bind to. Pass 0.0.0.0 to listens on all interfaces including the external one. (default: localhost)")
     parser.add_argument("--port", default = 7085, type = int, help = "Set the port that cork listens on (default: 7085)")
     parser.add_argument("--server", default="wsgiref", help = "Switch the server backend (default: wsgiref)")
+    parser.add_argument("--router", default = "bottle", choices = ["bottle", "trie"], help = "How requests are matched to routes: by trying bottle's regular expressions in turn, or by looking them up in a trie of path segments, which stays fast with hundreds of routes. (default: bottle)")
+    
+    parser.add_argument("--cache-size", default = 64 * 1024 * 1024, type = int, metavar = "BYTES", help = "Maximum number of bytes of file data kept in memory, counting both files preloaded with --preload and files cached by read(). Pass 0 to disable the cache. (default: 64MB)")
+    
+    parser.add_argument("--preload", metavar = "DIR", help = "Read every file under DIR in to memory at startup. read() serves preloaded files without touching the filesystem, so changes to them are not picked up until cork is restarted.")
+    
+    parser.add_argument("--state-max-entries", type = int, metavar = "N", help = "Evict the least recently used state keys when there are more than N of them.")
+    
+    parser.add_argument("--state-max-bytes", type = int, metavar = "BYTES", help = "Evict the least recently used state keys when their keys and values use more than BYTES.")
+    
+    parser.add_argument("--state-file", metavar = "PATH", help = "Keep state on disk, in a snapshot at PATH and a log of changes at PATH.log, and load it again at startup.")
+    
+    parser.add_argument("--state-fsync", default = "interval", choices = StateJournal.policies, help = "How often changes to the --state-file are synced to disk: after every change, once a second, or whenever the OS decides to. (default: interval)")
+    parser.add_argument("--state-socket", metavar = "PATH", help = "Share state with every other cork process started with the same PATH. The first serves it on a unix socket at PATH, the rest keep replicas of it.")
     
     parser.add_argument("--config", metavar = "CONFIG.PY", help = "Path to a .py file to get loaded at startup. Use this to add configuration options to a service.")
     
-    parser.add_argument("--set-state", nargs = '+', metavar = "KEY=VALUE", help = "Send a POST request to <HOST>:<PORT>/~cork/<KEY> to associate <VALUE> with <KEY> in the recieving service's state dictionary.")
-    parser.add_argument("--get-state", nargs = "*", metavar = "KEY", help = "Send a GET request to <HOST>:<PORT>/~cork/<KEY> to retrieve the value associated with <KEY>. If <KEY> is not specified, returns all currently set values.")
+    parser.add_argument("--set-state", nargs = '+', metavar = "KEY=VALUE", help = "Send a POST request to <HOST>:<PORT>/~cork/bulk to associate each <VALUE> with its <KEY> in the recieving service's state dictionary. Everything after the first '=' is the value.")
+    parser.add_argument("--get-state", nargs = "*", metavar = "KEY", help = "Send a GET request to <HOST>:<PORT>/~cork/bulk to retrieve the values associated with each <KEY>. If <KEY> is not specified, returns all currently set values.")
+    parser.add_argument("--session", metavar = "NAME", help = "Send --set-state and --get-state requests for the session NAME, whose state is kept apart from other sessions'.")
     
     args = parser.parse_args()
     
+    # the state of a session is kept apart from everyone else's
+    session = {'X-Cork-Session': args.session} if args.session is not None else {}
+    
     # do this when the user is requesting state
     if args.get_state is not None:
         c = httplib.HTTPConnection(args.host, args.port)
         if args.get_state == []:
-            c.request('GET', "/~cork")
+            c.request('GET', "/~cork", headers = session)
             r = c.getresponse()
             if r.status == 200:
-                if len(r.read()) > 0:
-                    print(r.read())
+                body = r.read()
+                if len(body) > 0:
+                    print(body)
         else:
+            # fetch every key in a single request
+            c.request('GET', "/~cork/bulk?%s" % urllib.urlencode([('key', q) for q in args.get_state]), headers = session)
+            r = c.getresponse()
+            if r.status != 200:
+                raise RuntimeError("error GETting state (status %d)" % r.status)
+            values = json.loads(r.read())
             for q in args.get_state:
-                c.request('GET', "/~cork/%s" % q)
-                r = c.getresponse()
-                print(r.read())
+                value = values.get(q.decode('utf-8'))
+                if value is None:
+                    value = u''
+                elif not isinstance(value, basestring):
+                    value = json.dumps(value) # from a cork that sent values as they were
+                print("%s=%s" % (q, value.encode('utf-8')))
         c.close()
         exit()
         
     # do this when the user is sending state
     if args.set_state is not None:
         c = httplib.HTTPConnection(args.host, args.port)
-        for kv in args.set_state:
+        
+        def post_state(path, body, headers = {}):
             try:
-                k = kv.split('=')[0]
-                v = kv.split('=')[1]
-            except IndexError:
+                c.request('POST', "/~cork/%s" % path, body = body, headers = dict(session, **headers))
+                r = c.getresponse()
+                r.read()
+                if r.status != 200:
+                    raise RuntimeError("error POSTing to /~cork/%s (status %d)" % (path, r.status))
+            except httplib.BadStatusLine:
+                pass # This error happens when we send a 'stop' command
+        
+        pending = OrderedDict()
+        for kv in args.set_state:
+            k, sep, v = kv.partition('=') # only split on the first '=', values may contain more
+            if not sep:
                 print('Argument must be in the form "KEY=VALUE" (was "%s")' % kv)
                 exit(-1)
-            if args.service is None:
-                # if no service is passed, we assume we're setting it via HTTP
-                try:
-                    c.request('POST', "/~cork/%s" % k, body = v)
-                    r = c.getresponse()
-                    if r.status != 200:
-                        raise RuntimeError("error POSTing %s=%s (status %d)" % (k, v, r.status))
-                except httplib.BadStatusLine:
-                    pass # This error happens when we send a 'stop' command
-            else:
-                # otherwise, it means we just set the state directly, and then load the service
+            if args.service is not None:
+                # if we're given a service, we just set the state directly, and then load the service
                 cork.state[k] = v
+            elif k in ('stop', 'reset'):
+                # commands are sent on their own, after any values that came before them
+                if pending:
+                    post_state('bulk', json.dumps(pending), {'Content-Type': 'application/json'})
+                    pending.clear()
+                post_state(k, v)
+            else:
+                pending[k] = v
+        if pending:
+            # if no service is passed, we send every value to the running service in a single request
+            post_state('bulk', json.dumps(pending), {'Content-Type': 'application/json'})
                 
         c.close()
         if args.service is None:
@@ -313,20 +2919,71 @@ if __name__ == '__main__':
         args.verbose = True
     debug("bottle.debug = %r" % args.debug)
     
+    cache.max_bytes = args.cache_size
+    state.configure(max_entries = args.state_max_entries, max_bytes = args.state_max_bytes)
+    
     # load the service
     args.service = os.path.abspath(args.service)
+    if args.preload is not None:
+        args.preload = os.path.abspath(args.preload)
+    if args.state_file is not None:
+        args.state_file = os.path.abspath(args.state_file)
+    if args.state_socket is not None:
+        args.state_socket = os.path.abspath(args.state_socket)
     os.chdir(os.path.dirname(args.service)) # switch to the directory containing the service script
+    if args.router == "trie":
+        use_trie_router() # before the service adds its routes
     try:
         execfile(args.service)
     except IOError:
         print("There was an error loading the service '%s'" % args.service)
         exit(-1)
         
+    # warm up the read cache
+    if args.preload is not None:
+        started = time.time()
+        count = cache.preload(args.preload)
+        print("preloaded %d files (%d bytes) from '%s' in %.1fms" % \
+            (count, cache.preloaded_bytes, args.preload, (time.time() - started) * 1000))
+        if cache.preload_skipped:
+            print("left %d files on disk that didn't fit in --cache-size" % cache.preload_skipped)
+        
+    # restore saved state over anything the service set when it loaded
     # add functionality for the gevent asynchronous wsgi server (recommended)
     if "gevent" in args.server:
         from gevent import monkey
         monkey.patch_all()
 
+    # share state with the other cork processes using the same socket
+    shared = True
+    if args.state_socket is not None:
+        try:
+            shared = state.share(args.state_socket)
+        except ValueError, e:
+            print("Can't share state: %s" % e)
+            exit(-1)
+        if shared:
+            print("serving state to other cork processes on '%s'" % args.state_socket)
+        else:
+            print("using the state served on '%s'" % args.state_socket)
+
+    # only the process that serves the state keeps its journal; the others' changes reach it through the server
+    journal = None
+    if args.state_file is not None and not shared:
+        print("state is served from '%s', so '%s' is left to its server" % (args.state_socket, args.state_file))
+    elif args.state_file is not None:
+        started = time.time()
+        journal = StateJournal(args.state_file, args.state_fsync)
+        count = journal.load(state.default) # sessions are for test runs, and aren't saved
+        print("loaded %d state keys from '%s' in %.1fms" % (count, args.state_file, (time.time() - started) * 1000))
+        
+    Pseudorandom.load_corpora()
+
+    # expired state keys are dropped as they're read, and every so often by the sweeper
+    state.start_sweeper()
+    if journal is not None:
+        journal.start(state.default)
+
     # now start the server
     try:
         run(server = args.server, \
@@ -335,4 +2992,9 @@ if __name__ == '__main__':
             #reloader = args.reloader)
 
     except SystemExit:
-        log("caught SystemExit signal, terminating")
\ No newline at end of file
+        log("caught SystemExit signal, terminating")
+    
+    log("read cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions" % cache.stats())
+    log("state: %(entries)d keys, %(expirations)d expired, %(evictions)d evicted" % state.default.stats())
+    if journal is not None:
+        journal.close()
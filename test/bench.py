@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# benchmarks for cork's helpers
+#
+# usage: python test/bench.py [BENCHMARK ...]
+# runs every benchmark if none are named
+
+import os, sys, timeit, random
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cork
+
+benchmarks = OrderedDict()
+
+def benchmark(func):
+    benchmarks[func.__name__] = func
+    return func
+
+def report(label, seconds, n):
+    print("  %-40s %10.2f us/op" % (label, seconds / n * 1e6))
+
+def best_of(func, n, repeat = 5):
+    # the fastest of several runs is the least noisy estimate
+    return min(timeit.repeat(func, number = n, repeat = repeat))
+
+################################################################################
+# Pseudorandom
+################################################################################
+
+def legacy_random_string(prnd, pattern):
+    # random_string() as it was before patterns were compiled
+    chars = {"#": "0123456789",
+             "$": "ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+             "*": "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+            }
+    rv = ''
+    for c in pattern:
+        if c in chars:
+            rv += prnd.choice(chars[c])
+        else:
+            rv += c
+    return rv
+
+@benchmark
+def random_string():
+    pattern = "(###)-###-#### ****-****-****-****"
+    prnd = cork.Pseudorandom(1)
+    n = 10000
+    report("legacy random_string()", best_of(lambda: legacy_random_string(prnd, pattern), n), n)
+    report("random_string()", best_of(lambda: prnd.random_string(pattern), n), n)
+    report("random_strings(pattern, 1000) per value", best_of(lambda: prnd.random_strings(pattern, 1000), n / 1000), n)
+
+class LegacyPseudorandom(cork.Pseudorandom):
+    # construction as it was before Random.__init__() was skipped
+    def __init__(self, *args):
+        random.Random.__init__(self)
+        self.seed(*args)
+
+@benchmark
+def construction():
+    n = 20000
+    for name, cls in (("legacy Pseudorandom", LegacyPseudorandom), ("Pseudorandom", cork.Pseudorandom)):
+        report("%s: construct" % name, best_of(lambda: cls("username", 12345), n), n)
+        report("%s: construct + 5 draws" % name, best_of(lambda: cls("username", 12345).random_string("#####"), n), n)
+
+@benchmark
+def records():
+    schema = [("id", "USR-######"), ("plan", ("free", "premium", "enterprise")), ("status", {"active": 9, "closed": 1})]
+    n = 10000
+    def loop(prnd):
+        # the same three fields drawn from one generator, with no per-record seeding
+        for i in xrange(n):
+            {"id": prnd.random_string("USR-######"), "plan": prnd.choice("free", "premium", "enterprise"),
+             "status": prnd.weighted_choice({"active": 9, "closed": 1})}
+    prnd = cork.Pseudorandom("users", 1)
+    report("plain loop per record", best_of(lambda: loop(prnd), 1, repeat = 3), n)
+    report("records() per record", best_of(lambda: list(prnd.records(schema, n)), 1, repeat = 3), n)
+
+################################################################################
+# Routing
+################################################################################
+
+@benchmark
+def routers():
+    import bottle
+    n = 20000
+    for count in (10, 100, 1000):
+        # the multi-port proxy pattern from the readme, with a typed route per port for good measure
+        rules = []
+        for i in range(count / 2):
+            rules.append('/%d/<path:path>' % (4000 + i))
+            rules.append('/api/v%d/users/<id:int>' % i)
+        first, last = '/4000/a/b.xml', '/api/v%d/users/12' % (count / 2 - 1)
+        for name, router in (("Router", bottle.Router()), ("TrieRouter", cork.TrieRouter())):
+            for rule in rules:
+                router.add(rule, 'GET', rule)
+            for label, path in (("first route", first), ("last route", last)):
+                environ = {'PATH_INFO': path, 'REQUEST_METHOD': 'GET'}
+                report("%d routes, %s: %s" % (count, name, label), best_of(lambda: router.match(environ), n), n)
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or benchmarks.keys()
+    for name in names:
+        if name not in benchmarks:
+            print("unknown benchmark '%s' (choose from: %s)" % (name, ", ".join(benchmarks)))
+            exit(-1)
+    for name in names:
+        print(name)
+        benchmarks[name]()
@@ -1,5 +1,9 @@
-import unittest
-import cork
+import unittest, argparse, os, sys, shutil, subprocess, tempfile, threading, time, gzip, zlib, json
+from StringIO import StringIO
+import bottle, cork
+
+# cork's logging helpers expect the launcher's parsed arguments
+cork.args = argparse.Namespace(verbose = False, debug = False)
 
 class PseudorandomTest(unittest.TestCase):
     def testSeed(self):
@@ -12,3 +16,974 @@ class PseudorandomTest(unittest.TestCase):
         prnd.seed(555)
         
         self.failUnless(prnd.random() == control_value)
+
+class ReadCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "response.xml")
+        with open(self.filename, 'w') as f:
+            f.write("<response/>")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testHitsAndMisses(self):
+        cache = cork.ReadCache()
+        self.assertEqual(cache.get(self.filename).data, "<response/>")
+        self.assertEqual(cache.get(self.filename).data, "<response/>")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def testStaleEntryIsReloaded(self):
+        cache = cork.ReadCache()
+        cache.get(self.filename)
+        with open(self.filename, 'w') as f:
+            f.write("<response>changed</response>")
+        os.utime(self.filename, (time.time() + 10, time.time() + 10))
+        self.assertEqual(cache.get(self.filename).data, "<response>changed</response>")
+        self.assertEqual(cache.misses, 2)
+
+    def testEvictsLeastRecentlyUsed(self):
+        cache = cork.ReadCache(max_bytes = 20)
+        names = []
+        for name, body in (("other.xml", "<other/>"), ("third.xml", "<x/>")):
+            names.append(os.path.join(self.dir, name))
+            with open(names[-1], 'w') as f:
+                f.write(body)
+        cache.get(self.filename)
+        cache.get(names[0])
+        cache.get(self.filename)
+        cache.get(names[1]) # pushes the cache over budget
+        self.assertEqual(cache.entries.keys(), [self.filename, names[1]])
+        self.assertEqual(cache.evictions, 1)
+
+class ReadMappedTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, body):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'wb') as f:
+            f.write(body)
+        return filename
+
+    def testChunkedRead(self):
+        body = "".join(chr(i % 256) for i in range(100000))
+        mapped = cork.read_mapped(self.write("large.bin", body))
+        chunks = []
+        for chunk in iter(lambda: mapped.read(8192), ''):
+            chunks.append(chunk)
+        mapped.close()
+        self.assertEqual("".join(chunks), body)
+        self.assertEqual(len(chunks), 13)
+
+    def testEmptyFile(self):
+        mapped = cork.read_mapped(self.write("empty.json", ""))
+        self.assertEqual((len(mapped), mapped.read()), (0, ""))
+        mapped.close()
+
+class PreloadTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, "data", "nested"))
+        for name in ("response.xml", os.path.join("nested", "user.json")):
+            with open(os.path.join(self.dir, "data", name), 'w') as f:
+                f.write(name)
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+        cork.cache.clear()
+
+    def testPreloadedFilesSkipTheDisk(self):
+        self.assertEqual(cork.cache.preload("data"), 2)
+        os.remove(os.path.join("data", "response.xml"))
+        self.assertEqual(cork.read("data/response.xml"), "response.xml")
+        self.assertEqual(cork.read(os.path.abspath("data/response.xml")), "response.xml")
+        self.assertEqual(cork.cache.misses, 0)
+
+    def testBigFilesStayOnDisk(self):
+        cork.cache.max_bytes = 50
+        try:
+            with open(os.path.join("data", "big.bin"), 'w') as f:
+                f.write("x" * 100)
+            self.assertEqual(cork.cache.preload("data"), 2)
+            self.assertEqual((cork.cache.preload_skipped, cork.cache.preloaded_bytes), (1, 28))
+            self.assertFalse(os.path.abspath("data/big.bin") in cork.cache.index) # so serve() maps it
+            cork.cache.put(cork.CannedFile("big", 0, 30, "x" * 30))
+            self.assertEqual(cork.cache.size, 0) # it would fit in 50, but not next to what's preloaded
+            cork.cache.put(cork.CannedFile("other", 0, 22, "x" * 22)) # only 22 of the 50 bytes are left
+            self.assertEqual(cork.cache.size, 22)
+            cork.cache.put(cork.CannedFile("another", 0, 1, "x"))
+            self.assertTrue(cork.cache.size + cork.cache.preloaded_bytes <= 50)
+        finally:
+            cork.cache.max_bytes = 64 * 1024 * 1024
+
+    def testVariantsStayInBudget(self):
+        cork.cache.preload("data")
+        cork.cache.max_bytes = cork.cache.preloaded_bytes + 1
+        try:
+            entry = cork.cache.index[os.path.abspath("data/response.xml")]
+            self.assertEqual(zlib.decompress(cork.cache.variant(entry, "deflate")), "response.xml")
+            self.assertFalse("deflate" in entry.variants) # compressed again next time, rather than kept
+            self.assertEqual(cork.cache.preloaded_bytes, cork.cache.max_bytes - 1)
+        finally:
+            cork.cache.max_bytes = 64 * 1024 * 1024
+
+class ServeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "response.xml")
+        self.body = "<response>%s</response>" % ("<item/>" * 1000)
+        with open(self.filename, 'w') as f:
+            f.write(self.body)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+        cork.cache.clear()
+
+    def serve(self, **environ):
+        bottle.request.bind(environ)
+        return cork.serve(self.filename)
+
+    def testIdentity(self):
+        rv = self.serve()
+        self.assertEqual(rv.output, self.body)
+        self.assertEqual(rv.headers['Content-Length'], str(len(self.body)))
+        self.assertEqual(rv.headers['Content-Type'], "application/xml")
+        self.assertEqual(rv.headers['Vary'], "Accept-Encoding")
+        self.assertFalse('Content-Encoding' in rv.headers)
+
+    def testGzip(self):
+        rv = self.serve(HTTP_ACCEPT_ENCODING = "deflate;q=0.5, gzip")
+        self.assertEqual(rv.headers['Content-Encoding'], "gzip")
+        self.assertEqual(rv.headers['Content-Length'], str(len(rv.output)))
+        self.assertEqual(gzip.GzipFile(fileobj = StringIO(rv.output)).read(), self.body)
+        # the compressed variant is kept with the cached file
+        self.assertTrue(self.serve(HTTP_ACCEPT_ENCODING = "gzip").output is rv.output)
+
+    def testDeflate(self):
+        rv = self.serve(HTTP_ACCEPT_ENCODING = "gzip;q=0, deflate")
+        self.assertEqual(rv.headers['Content-Encoding'], "deflate")
+        self.assertEqual(zlib.decompress(rv.output), self.body)
+
+    def testGzipSibling(self):
+        with open(self.filename + ".gz", 'wb') as f:
+            f.write("precompressed")
+        self.assertEqual(self.serve(HTTP_ACCEPT_ENCODING = "gzip").output, "precompressed")
+
+    def testETag(self):
+        rv = self.serve()
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH = rv.headers['ETag']).status, 304)
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH = '"stale", *').status, 304)
+        self.assertEqual(self.serve(HTTP_IF_NONE_MATCH = '"stale"').status, 200)
+        gzipped = self.serve(HTTP_ACCEPT_ENCODING = "gzip")
+        self.assertNotEqual(gzipped.headers['ETag'], rv.headers['ETag'])
+        not_modified = self.serve(HTTP_ACCEPT_ENCODING = "gzip", HTTP_IF_NONE_MATCH = gzipped.headers['ETag'])
+        self.assertEqual((not_modified.status, not_modified.output), (304, ''))
+
+    def testSingleRange(self):
+        rv = self.serve(HTTP_RANGE = "bytes=10-19", HTTP_ACCEPT_ENCODING = "gzip")
+        self.assertEqual((rv.status, rv.output), (206, self.body[10:20]))
+        self.assertEqual(rv.headers['Content-Range'], "bytes 10-19/%d" % len(self.body))
+        self.assertFalse('Content-Encoding' in rv.headers)
+        self.assertEqual(self.serve(HTTP_RANGE = "bytes=-5").output, self.body[-5:])
+
+    def testMultipleRanges(self):
+        rv = self.serve(HTTP_RANGE = "bytes=0-4, 20-")
+        body = "".join(rv.output)
+        self.assertEqual(rv.status, 206)
+        self.assertEqual(rv.headers['Content-Length'], str(len(body)))
+        boundary = rv.headers['Content-Type'].split("boundary=")[1]
+        parts = body.split("--%s" % boundary)
+        self.assertEqual(len(parts), 4)
+        self.assertTrue(parts[1].endswith("\r\n\r\n%s\r\n" % self.body[:5]))
+        self.assertTrue(parts[2].endswith("\r\n\r\n%s\r\n" % self.body[20:]))
+        self.assertEqual(parts[3], "--\r\n")
+
+    def testIfRange(self):
+        etag = self.serve().headers['ETag']
+        self.assertEqual(self.serve(HTTP_RANGE = "bytes=0-4", HTTP_IF_RANGE = etag).status, 206)
+        self.assertEqual(self.serve(HTTP_RANGE = "bytes=0-4", HTTP_IF_RANGE = '"stale"').status, 200)
+
+    def testUnsatisfiableRange(self):
+        rv = self.serve(HTTP_RANGE = "bytes=%d-" % len(self.body))
+        self.assertEqual(rv.status, 416)
+        self.assertEqual(rv.headers['Content-Range'], "bytes */%d" % len(self.body))
+        self.assertEqual(self.serve(HTTP_RANGE = "bytes=9-3").status, 200) # malformed, so ignored
+
+    def testUncacheableFilesAreMapped(self):
+        cork.cache.max_bytes = 100
+        try:
+            rv = self.serve(HTTP_RANGE = "bytes=100-199")
+            self.assertEqual("".join(rv.output), self.body[100:200])
+            rv = self.serve(HTTP_ACCEPT_ENCODING = "gzip")
+            self.assertTrue(isinstance(rv.output, cork.MappedFile))
+            self.assertEqual(rv.output.read(), self.body)
+            rv.output.close()
+        finally:
+            cork.cache.max_bytes = 64 * 1024 * 1024
+
+class RandomLineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "names.txt")
+        with open(self.filename, 'w') as f:
+            f.write("first\n\n   \nsecond with a much longer line than the others\nthird\nlast")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testEveryLineIsReachable(self):
+        prnd = cork.Pseudorandom(1)
+        lines = set(prnd.random_line(self.filename) for i in range(200))
+        self.assertEqual(lines, set(["first", "second with a much longer line than the others", "third", "last"]))
+
+    def testDeterministic(self):
+        a, b = cork.Pseudorandom("seed"), cork.Pseudorandom("seed")
+        self.assertEqual([a.random_line(self.filename) for i in range(10)],
+                         [b.random_line(self.filename) for i in range(10)])
+
+    def testRewritten(self):
+        prnd = cork.Pseudorandom(1)
+        prnd.random_line(self.filename)
+        with open(self.filename, 'w') as f:
+            f.write("short")
+        os.utime(self.filename, (0, 0)) # in case the rewrite lands in the same mtime tick
+        self.assertEqual(prnd.random_line(self.filename), "short")
+
+    def testNoFileDescriptorsLeak(self):
+        if not os.path.isdir("/proc/self/fd"):
+            return
+        prnd = cork.Pseudorandom(1)
+        prnd.random_line(self.filename)
+        before = len(os.listdir("/proc/self/fd"))
+        for i in range(1000):
+            prnd.random_line(self.filename)
+        self.assertEqual(len(os.listdir("/proc/self/fd")), before)
+
+class RandomStringTest(unittest.TestCase):
+    def legacy_random_string(self, prnd, pattern):
+        # the original implementation, which random_string() must stay compatible with
+        chars = {"#": "0123456789", "$": "ABCDEFGHIJKLMNOPQRSTUVWXYZ", "*": "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"}
+        rv = ''
+        for c in pattern:
+            rv += prnd.choice(chars[c]) if c in chars else c
+        return rv
+
+    def testSameSequenceAsBefore(self):
+        pattern = "(###)-###-#### $$-**"
+        a, b = cork.Pseudorandom(42), cork.Pseudorandom(42)
+        for i in range(50):
+            self.assertEqual(a.random_string(pattern), self.legacy_random_string(b, pattern))
+
+    def testBatch(self):
+        a, b = cork.Pseudorandom(42), cork.Pseudorandom(42)
+        self.assertEqual(a.random_strings("ID-****", 100), [b.random_string("ID-****") for i in range(100)])
+        self.assertEqual(a.random_strings(u"no replacements", 2), [u"no replacements"] * 2)
+
+    def testPatternCacheIsBounded(self):
+        prnd = cork.Pseudorandom(42)
+        for i in range(2000):
+            self.assertEqual(len(prnd.random_string("ID-%d-###" % i)), len("ID-%d-###" % i))
+        self.assertTrue(len(cork.Pseudorandom._patterns) <= 1000)
+
+class HashArgsTest(unittest.TestCase):
+    def testOrderAndCollisions(self):
+        prnd = cork.Pseudorandom()
+        self.assertNotEqual(prnd.hash_args(1, 2), prnd.hash_args(2, 1))
+        self.assertNotEqual(prnd.hash_args(1, 1), prnd.hash_args(0))
+        self.assertNotEqual(prnd.hash_args("1"), prnd.hash_args(1))
+        self.assertNotEqual(prnd.hash_args("ab", "c"), prnd.hash_args("a", "bc"))
+        self.assertEqual(prnd.hash_args({"a": 1, "b": [2]}), prnd.hash_args({"b": [2], "a": 1}))
+        self.assertEqual(prnd.hash_args(None), prnd.hash_args(None))
+        self.assertTrue(0 <= prnd.hash_args("user", 2) < 2 ** 64)
+
+    def testStableAcrossProcesses(self):
+        args = '"user", u"\\u00e9", 3.5, {"key": [1, 2]}, None'
+        script = "import cork; print(cork.Pseudorandom().hash_args(%s))" % args
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        results = set()
+        for i in range(3):
+            # -R turns on hash randomisation
+            out = subprocess.check_output([sys.executable, "-R", "-c", script], cwd = root)
+            results.add(int(out))
+        self.assertEqual(results, set([eval("cork.Pseudorandom().hash_args(%s)" % args)]))
+
+    def testGetSeed(self):
+        prnd = cork.Pseudorandom("user")
+        self.assertEqual(prnd.get_seed(), prnd.hash_args("user"))
+
+class CounterTest(unittest.TestCase):
+    def testAtMatchesTheSequence(self):
+        prnd = cork.Pseudorandom("page", 1)
+        prnd._reseed(1234567)
+        # first SplitMix64 outputs for seed 1234567, from the reference implementation
+        expected = [6457827717110365317, 3203168211198807973, 9817491932198370423]
+        prnd.random() # drawing from the instance doesn't affect at()
+        self.assertEqual([prnd.at(i) for i in range(3)], [(z >> 11) * 2.0 ** -53 for z in expected])
+        self.assertNotEqual(prnd.at(4999), prnd.at(4998))
+
+    def testFork(self):
+        a = cork.Pseudorandom("list", 3)
+        a.random()
+        self.assertEqual(a.fork(5000).random_string("****"), cork.Pseudorandom("list", 3).fork(5000).random_string("****"))
+        self.assertNotEqual(a.fork(1).random(), a.fork(2).random())
+        self.assertRaises(ValueError, cork.Pseudorandom().fork, 1)
+
+class WeightedChoiceTest(unittest.TestCase):
+    def testDistribution(self):
+        prnd = cork.Pseudorandom(12)
+        picks = prnd.weighted_choices(["free", "premium", "enterprise", "never"], [70, 25, 5, 0], 20000)
+        counts = dict((k, picks.count(k)) for k in set(picks))
+        self.assertFalse("never" in counts)
+        self.assertTrue(abs(counts["free"] / 20000.0 - 0.70) < 0.02)
+        self.assertTrue(abs(counts["enterprise"] / 20000.0 - 0.05) < 0.01)
+
+    def testDeterministic(self):
+        weights = {200: 90, 404: 7, 500: 3}
+        a, b = cork.Pseudorandom("status"), cork.Pseudorandom("status")
+        self.assertEqual([a.weighted_choice(weights) for i in range(50)], b.weighted_choices(weights, n = 50))
+        table = cork.AliasTable([90, 7, 3])
+        self.assertTrue(a.weighted_choice([200, 404, 500], table) in (200, 404, 500))
+
+    def testInvalidWeights(self):
+        prnd = cork.Pseudorandom(1)
+        self.assertRaises(ValueError, prnd.weighted_choice, ["a", "b"], [0, 0])
+        self.assertRaises(ValueError, prnd.weighted_choice, ["a", "b"], [1, 2, 3])
+
+class RecordsTest(unittest.TestCase):
+    schema = {"id": "USR-######",
+              "plan": ("free", "premium", "enterprise"),
+              "status": {"active": 9, "closed": 1},
+              "age": lambda prnd: prnd.randint(18, 90),
+              "kind": "user"}
+
+    def testFields(self):
+        records = cork.Pseudorandom("users", 1).records(self.schema, 3)
+        self.assertFalse(isinstance(records, list)) # records are generated lazily
+        for record in records:
+            self.assertEqual(sorted(record), ["age", "id", "kind", "plan", "status"])
+            self.assertTrue(record["id"].startswith("USR-") and record["id"][4:].isdigit())
+            self.assertTrue(record["plan"] in self.schema["plan"])
+            self.assertTrue(record["status"] in ("active", "closed"))
+            self.assertTrue(18 <= record["age"] <= 90)
+            self.assertEqual(record["kind"], "user")
+
+    def testPaging(self):
+        prnd = cork.Pseudorandom("users", 1)
+        everything = list(prnd.records(self.schema, 60))
+        self.assertEqual(list(prnd.records(self.schema, 10, start = 50)), everything[50:])
+        self.assertNotEqual(everything[0], everything[1])
+        cork.Pseudorandom._seeds.clear()
+        list(prnd.records(self.schema, 100))
+        self.assertEqual(len(cork.Pseudorandom._seeds), 0) # records aren't seeded through the memo
+
+    def testStreamJson(self):
+        records = cork.Pseudorandom("users", 1).records(self.schema, 5)
+        self.assertEqual(len(json.loads("".join(cork.stream_json(records)))), 5)
+        self.assertEqual("".join(cork.stream_json([])), "[]")
+
+class CorporaTest(unittest.TestCase):
+    def corpus(self, name):
+        with open(os.path.join(os.path.dirname(cork.__file__), "corpora", name + ".txt")) as f:
+            return set(line.strip() for line in f)
+
+    def testValuesComeFromTheCorpora(self):
+        prnd = cork.Pseudorandom("fake data")
+        first_names, last_names, cities = self.corpus("first_names"), self.corpus("last_names"), self.corpus("cities")
+        for i in range(20):
+            self.assertTrue(prnd.first_name() in first_names)
+            first, last = prnd.full_name().split(" ")
+            self.assertTrue(first in first_names and last in last_names)
+            self.assertTrue(prnd.city() in cities)
+            number, street = prnd.street_address().split(" ", 1)
+            self.assertTrue(number.isdigit() and street.split(" ")[-1] in cork.Pseudorandom._street_suffixes)
+            self.assertTrue(prnd.company().split(" ")[0] in set(c.split(" ")[0] for c in self.corpus("companies")))
+
+    def testSameValuesAsRandomLine(self):
+        a, b = cork.Pseudorandom(7), cork.Pseudorandom(7)
+        filename = os.path.join(os.path.dirname(cork.__file__), "corpora", "cities.txt")
+        self.assertEqual([a.city() for i in range(10)], [b.random_line(filename) for i in range(10)])
+
+    def testCorporaAreNotStatted(self):
+        cork.Pseudorandom.load_corpora()
+        stat = os.stat
+        def no_stat(filename):
+            raise AssertionError("stat(%s)" % filename)
+        os.stat = no_stat
+        try:
+            cork.Pseudorandom(7).full_name()
+        finally:
+            os.stat = stat
+
+    def testEmail(self):
+        prnd = cork.Pseudorandom("fake data")
+        local, domain = prnd.email("Ada", "Lovelace").split("@")
+        self.assertTrue(local.startswith("ada.lovelace") and local[-2:].isdigit())
+        self.assertTrue(domain in cork.Pseudorandom._email_domains)
+        self.assertEqual(cork.Pseudorandom(9).email(), cork.Pseudorandom(9).email())
+
+class StateStoreTest(unittest.TestCase):
+    def testDictApi(self):
+        store = cork.StateStore()
+        store["a"] = "1"
+        store.update(b = "2", c = "3")
+        self.assertEqual((store["a"], store.get("b"), store.get("missing", "x")), ("1", "2", "x"))
+        self.assertEqual(sorted(store), ["a", "b", "c"])
+        self.assertEqual(store.pop("c"), "3")
+        self.assertEqual(store.setdefault("a", "ignored"), "1")
+        del store["b"]
+        self.assertEqual(store.copy(), {"a": "1"})
+        store.clear()
+        self.assertEqual(len(store), 0)
+
+    def testConcurrentWriters(self):
+        store = cork.StateStore()
+        def writer(n):
+            for i in range(500):
+                store["%d/%d" % (n, i)] = i
+                list(store) # iterating while others write must not fail
+        threads = [threading.Thread(target = writer, args = (n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(store), 8 * 500)
+
+    def testVersions(self):
+        store = cork.StateStore()
+        self.assertEqual(store.version("a"), 0)
+        store["a"] = "1"
+        first = store.version("a")
+        store["a"] = "1"
+        self.assertTrue(store.version("a") > first)
+        store.setdefault("a", "2") # no change, no new version
+        second = store.version("a")
+        self.assertEqual(store.version("a"), second)
+        store.clear()
+        self.assertTrue(store.version("a") > second)
+
+    def testWatch(self):
+        store = cork.StateStore()
+        self.assertEqual(store.watch("a", 0, timeout = 0.01), 0) # times out
+        store["a"] = "1"
+        self.assertEqual(store.watch("a", 0), store.version("a")) # already changed
+        version = store.version("a")
+        timer = threading.Timer(0.05, store.__setitem__, ("a", "2"))
+        timer.start()
+        self.assertNotEqual(store.watch("a", version, timeout = 5), version)
+        self.assertEqual(store["a"], "2")
+        self.assertEqual(store._waiters, {})
+
+    def testTtl(self):
+        store = cork.StateStore()
+        store.set("a", "1", ttl = 0.05)
+        store.set("b", "2", ttl = 0.05)
+        store["c"] = "3"
+        self.assertEqual(store.get("a"), "1")
+        time.sleep(0.06)
+        self.assertFalse("a" in store) # expired lazily
+        self.assertEqual(sorted(store.keys()), ["c"])
+        self.assertEqual(store.sweep(), 1) # b
+        self.assertEqual((len(store), store.expirations), (1, 2))
+
+    def testEviction(self):
+        store = cork.StateStore(max_entries = 10)
+        for i in range(10):
+            store[i] = "x"
+        store.get(0) # recently used, so it survives
+        store[10] = "x"
+        self.assertEqual(len(store), 9)
+        self.assertEqual(store.evictions, 2)
+        self.assertEqual(sorted(store.keys()), [0, 3, 4, 5, 6, 7, 8, 9, 10])
+
+    def testBookkeepingIsBounded(self):
+        store = cork.StateStore(max_entries = 100)
+        for i in range(1000):
+            store[i] = "x"
+        self.assertTrue(len(store._versions) <= 100 and len(store._atime) <= 100)
+        for i in range(100):
+            store.set("t%d" % i, "x", ttl = 0.01)
+        time.sleep(0.02)
+        store.sweep()
+        self.assertTrue(len(store._versions) <= 100)
+        store["last"] = "x"
+        version = store.version("last")
+        del store["last"]
+        self.assertTrue("last" not in store._versions)
+        self.assertNotEqual(store.version("last"), version) # still counts as a change
+        store.clear()
+        self.assertEqual((store._versions, store._atime), ({}, {}))
+
+    def testScan(self):
+        store = cork.StateStore()
+        for key in ["b/2", "a", "b/1", "c", 7]:
+            store[key] = "x"
+        self.assertEqual(list(store.scan()), [7, "a", "b/1", "b/2", "c"])
+        store["b/0"] = "x" # the index is kept up to date once it's built
+        del store["b/2"]
+        self.assertEqual(list(store.scan("b/")), ["b/0", "b/1"])
+        self.assertEqual(list(store.scan("b/", after = "b/0")), ["b/1"])
+        self.assertEqual(list(store.scan(limit = 2)), [7, "a"])
+        self.assertEqual(list(store.scan(after = "a", limit = 2)), ["b/0", "b/1"])
+        store.clear()
+        self.assertEqual(list(store.scan()), [])
+
+    def testScanInChunks(self):
+        store = cork.StateStore()
+        store.scan_chunk = 2
+        for i in range(10):
+            store["k%d" % i] = "x"
+        scan = store.scan("k")
+        self.assertEqual([next(scan), next(scan), next(scan)], ["k0", "k1", "k2"])
+        del store["k3"] # changes between chunks are seen
+        store["k35"] = "x"
+        self.assertEqual(list(scan), ["k35", "k4", "k5", "k6", "k7", "k8", "k9"])
+        self.assertEqual(list(store.scan(after = "k5", limit = 3)), ["k6", "k7", "k8"])
+        store[7] = "x"
+        self.assertEqual(list(store.scan(after = 7)), ["k0", "k1", "k2", "k35", "k4", "k5", "k6", "k7", "k8", "k9"])
+
+    def testCheckpoint(self):
+        store = cork.StateStore()
+        store.update(a = "1", b = "2")
+        first = store.checkpoint()
+        store["a"] = "changed"
+        del store["b"]
+        store.set("c", "3", ttl = 60)
+        second = store.checkpoint()
+        store.clear()
+        store["d"] = "4"
+        self.assertEqual(store.copy(), {"d": "4"})
+        store.restore(second)
+        self.assertEqual(store.copy(), {"a": "changed", "c": "3"})
+        self.assertEqual(len(store), 2)
+        self.assertEqual(list(store.scan()), ["a", "c"])
+        store.restore(first)
+        self.assertEqual(store.copy(), {"a": "1", "b": "2"})
+        self.assertEqual((len(store), store.bytes), (2, 4))
+        store["b"] = "changed" # checkpoints aren't changed by writes after them
+        store.restore(first)
+        self.assertEqual(store["b"], "2")
+        store.drop(first)
+        self.assertRaises(KeyError, store.restore, first)
+
+    def testCheckpointWakesWatchers(self):
+        store = cork.StateStore()
+        id = store.checkpoint()
+        store["a"] = "1"
+        version = store.version("a")
+        threading.Timer(0.05, store.restore, (id,)).start()
+        self.assertNotEqual(store.watch("a", version, timeout = 5), version)
+        self.assertFalse("a" in store)
+
+    def testCheckpointLayers(self):
+        store = cork.StateStore()
+        for i in range(50):
+            store[i % 7] = str(i)
+            store.checkpoint()
+        self.assertTrue(len(store._layers) <= store.max_layers + 2)
+        self.assertEqual(store.copy(), dict((i % 7, str(i)) for i in range(43, 50)))
+
+    def testRestoredKeysCanBeEvicted(self):
+        store = cork.StateStore(max_entries = 10)
+        for i in range(10):
+            store[i] = "x"
+        id = store.checkpoint()
+        store.clear()
+        store.restore(id)
+        store["new"] = "x"
+        self.assertTrue("new" in store)
+        self.assertTrue(len(store) <= 10)
+
+    def testCompareAndSet(self):
+        store = cork.StateStore()
+        self.assertFalse(store.compare_and_set("a", 0, "1")) # not set yet
+        self.assertTrue(store.compare_and_set("a", None, "1"))
+        self.assertFalse(store.compare_and_set("a", None, "2"))
+        version = store.version("a")
+        self.assertTrue(store.compare_and_set("a", version, "2"))
+        self.assertFalse(store.compare_and_set("a", version, "3"))
+        self.assertEqual(store["a"], "2")
+
+    def testIncrAppend(self):
+        store = cork.StateStore()
+        self.assertEqual(store.incr("n"), 1)
+        self.assertEqual(store.incr("n", 5), 6)
+        store["s"] = "10"
+        self.assertEqual(store.incr("s", -3), "7")
+        store.set("log", "a", ttl = 60)
+        self.assertEqual(store.append("log", "b"), "ab")
+        self.assertTrue(store._entry("log")[1] is not None) # the ttl is kept
+        self.assertEqual(store.append("new", "x"), "x")
+        self.assertRaises(ValueError, store.incr, "log")
+        self.assertRaises(TypeError, store.append, "n", "x")
+
+    def testConcurrentIncr(self):
+        store = cork.StateStore()
+        def incr():
+            for i in range(1000):
+                store.incr("n")
+        threads = [threading.Thread(target = incr) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(store["n"], 8000)
+
+    def testByteBudget(self):
+        store = cork.StateStore(max_bytes = 1000)
+        for i in range(100):
+            store["%02d" % i] = "x" * 98
+        self.assertTrue(store.bytes <= 1000)
+        self.assertEqual(store.bytes, 100 * len(store))
+        self.assertTrue("99" in store)
+        del store["99"]
+        self.assertEqual(store.bytes, 100 * len(store))
+
+class StateJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "state")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def restart(self, store = None, fsync = 'always'):
+        if store is not None:
+            store.journal.close()
+        store = cork.StateStore()
+        cork.StateJournal(self.path, fsync).load(store)
+        return store
+
+    def testRoundTrip(self):
+        store = self.restart()
+        store["a"] = "1"
+        store.set("b", {"nested": [1, 2]}, ttl = 60)
+        store.set("gone", "x", ttl = 0.01)
+        store[3] = "three"
+        store["c"] = "2"
+        del store["c"]
+        time.sleep(0.02)
+        store = self.restart(store)
+        self.assertEqual(store.copy(), {"a": "1", "b": {"nested": [1, 2]}, 3: "three"})
+        self.assertTrue(0 < store._entry("b")[1] - time.time() <= 60)
+        store.clear()
+        store["d"] = "4"
+        self.assertEqual(self.restart(store).copy(), {"d": "4"})
+
+    def testCompact(self):
+        store = self.restart()
+        for i in range(100):
+            store["a"] = str(i)
+        self.assertTrue(store.journal.log_bytes() > 0)
+        store.journal.compact(store)
+        self.assertEqual(store.journal.log_bytes(), 0)
+        store["b"] = "1"
+        self.assertEqual(self.restart(store).copy(), {"a": "99", "b": "1"})
+
+    def testDamagedLog(self):
+        store = self.restart()
+        store["a"] = "1"
+        store.journal.close()
+        with open(self.path + ".log", 'ab') as f:
+            f.write("\x80\x02(U\x03set") # a change that was cut off part way
+        self.assertEqual(self.restart().copy(), {"a": "1"})
+
+    def testCheckpoints(self):
+        store = self.restart()
+        store["a"] = "1"
+        id = store.checkpoint()
+        store["a"] = "2"
+        store = self.restart(store)
+        self.assertEqual(store.copy(), {"a": "2"})
+        store.restore(id)
+        self.assertEqual(store.copy(), {"a": "1"})
+        store = self.restart(store)
+        self.assertEqual(store.copy(), {"a": "1"})
+        self.assertNotEqual(store.checkpoint(), id) # ids aren't reused after a restart
+
+    def testUnpicklable(self):
+        store = self.restart()
+        store["lock"] = threading.Lock()
+        store["a"] = "1"
+        self.assertEqual(self.restart(store).copy(), {"a": "1"})
+
+class StateShareTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "state.sock")
+        self.server = cork.StateSessions()
+        self.server["before"] = "1"
+        self.server.session("one")["a"] = "1"
+        self.assertTrue(self.server.share(self.path))
+        self.client = cork.StateSessions()
+        self.assertFalse(self.client.share(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def eventually(self, check):
+        # changes made elsewhere reach a replica soon, but not straight away
+        deadline = time.time() + 2
+        while not check() and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertTrue(check())
+
+    def testSync(self):
+        self.assertEqual(self.client.copy(), {"before": "1"})
+        self.assertEqual(self.client.session("one").copy(), {"a": "1"})
+        self.assertEqual(self.client.version("before"), self.server.version("before"))
+
+    def testWrites(self):
+        self.server["a"] = "1"
+        self.eventually(lambda: self.client.get("a") == "1")
+        self.client["b"] = "2"
+        self.assertEqual(self.client["b"], "2") # a process always reads its own changes
+        self.assertEqual(self.server["b"], "2")
+        self.assertEqual(self.client.version("b"), self.server.version("b"))
+        self.assertEqual(self.client.incr("n", 5), 5)
+        self.assertEqual(self.client["n"], 5)
+        self.assertFalse(self.client.compare_and_set("b", self.client.version("b") - 1, "3"))
+        self.assertTrue(self.client.compare_and_set("b", self.client.version("b"), "3"))
+        del self.client["a"]
+        self.assertFalse("a" in self.server)
+        self.assertRaises(TypeError, self.client.append, "n", "x")
+        self.assertRaises(KeyError, self.client.restore, "nope")
+
+    def testCheckpoints(self):
+        self.client["a"] = "1"
+        id = self.client.checkpoint()
+        self.client["a"] = "2"
+        self.server.restore(id)
+        self.eventually(lambda: self.client.get("a") == "1")
+        self.client.clear()
+        self.assertEqual(self.client.copy(), {})
+        self.client.restore(id)
+        self.assertEqual(self.client.copy(), self.server.copy())
+
+    def testSessions(self):
+        self.server.session("two")["b"] = "2"
+        self.eventually(lambda: self.client.session("two").get("b") == "2")
+        self.assertTrue(self.client.end("one"))
+        self.assertEqual(self.server.sessions(), {"two": 1})
+        self.eventually(lambda: self.client.sessions() == {"two": 1})
+
+    def testJournalAfterShare(self):
+        journal = cork.StateJournal(os.path.join(self.dir, "state.db"))
+        journal.load(self.server.default)
+        self.server["journaled"] = "1"
+        self.eventually(lambda: self.client.get("journaled") == "1") # still replicated
+        journal.close()
+        self.assertEqual(cork.StateJournal(os.path.join(self.dir, "state.db")).load(cork.StateStore()), 2)
+
+    def testNotASocket(self):
+        filename = os.path.join(self.dir, "state")
+        with open(filename, 'w') as f:
+            f.write("precious")
+        self.assertRaises(ValueError, cork.StateSessions().share, filename)
+        with open(filename) as f:
+            self.assertEqual(f.read(), "precious")
+
+    def testFork(self):
+        pid = os.fork()
+        if pid == 0:
+            # the child links to its parent's server the first time it uses the state
+            try:
+                self.server["forked"] = "1"
+                os._exit(0 if self.server.link is not None and self.server["before"] == "1" else 1)
+            finally:
+                os._exit(1)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(self.server["forked"], "1")
+        self.eventually(lambda: self.client.get("forked") == "1")
+
+class StateApiTest(unittest.TestCase):
+    def tearDown(self):
+        cork.state.clear()
+
+    def call(self, method, path, body = '', content_type = 'application/json', query = '', **headers):
+        # make a request through the WSGI app that cork's routes are registered with
+        status = []
+        environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'QUERY_STRING': query,
+                   'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(body)),
+                   'wsgi.input': StringIO(body)}
+        environ.update(headers)
+        output = ''.join(bottle.default_app()(environ, lambda s, h, e = None: status.append(s)))
+        return int(status[0].split()[0]), output
+
+    def testSet(self):
+        status, output = self.call('POST', '/~cork/bulk', json.dumps({"a": "1", "b": u"\u00e9", "c": 3, "d": "x=y"}))
+        self.assertEqual((status, json.loads(output)), (200, {"count": 4}))
+        self.assertEqual(cork.state.copy(), {"a": "1", "b": "\xc3\xa9", "c": "3", "d": "x=y"})
+
+    def testSetForm(self):
+        self.call('POST', '/~cork/bulk', "a=1&b=2", content_type = 'application/x-www-form-urlencoded')
+        self.assertEqual(cork.state.copy(), {"a": "1", "b": "2"})
+
+    def testSetInvalid(self):
+        self.assertEqual(self.call('POST', '/~cork/bulk', "{nope")[0], 400)
+        self.assertEqual(self.call('POST', '/~cork/bulk', "[1, 2]")[0], 400)
+        self.assertEqual(len(cork.state), 0)
+
+    def testWatch(self):
+        cork.state["a"] = "1"
+        version = cork.state.version("a")
+        status, output = self.call('GET', '/~cork/a', query = "wait=%d&timeout=0.01" % version)
+        self.assertEqual(status, 304)
+        threading.Timer(0.05, cork.state.__setitem__, ("a", "2")).start()
+        status, output = self.call('GET', '/~cork/a', query = "wait=%d&timeout=5" % version)
+        self.assertEqual((status, output), (200, "2"))
+        self.assertEqual(self.call('GET', '/~cork/a', query = "wait=x")[0], 400)
+
+    def testCheckpoint(self):
+        cork.state["a"] = "1"
+        status, output = self.call('POST', '/~cork/checkpoint')
+        id = json.loads(output)["id"]
+        cork.reset()
+        self.assertEqual(len(cork.state), 0)
+        self.assertEqual(self.call('POST', '/~cork/restore/%s' % id)[0], 200)
+        self.assertEqual(cork.state.copy(), {"a": "1"})
+        self.assertEqual(self.call('POST', '/~cork/drop/%s' % id)[0], 200)
+        self.assertEqual(self.call('POST', '/~cork/restore/%s' % id)[0], 404)
+
+    def testCompareAndSwap(self):
+        self.assertEqual(self.call('POST', '/~cork/a', "1", HTTP_IF_NONE_MATCH = "*")[0], 200)
+        self.assertEqual(self.call('POST', '/~cork/a', "2", HTTP_IF_NONE_MATCH = "*")[0], 412)
+        etag = bottle.response.headers['ETag']
+        self.assertEqual(self.call('POST', '/~cork/a', "2", HTTP_IF_MATCH = etag)[0], 200)
+        self.assertEqual(self.call('POST', '/~cork/a', "3", HTTP_IF_MATCH = etag)[0], 412)
+        self.assertEqual(cork.state["a"], "2")
+        self.assertEqual(self.call('POST', '/~cork/a', "3", HTTP_IF_MATCH = "*")[0], 200)
+        etag = bottle.response.headers['ETag']
+        self.assertEqual(self.call('POST', '/~cork/a', "4", HTTP_IF_NONE_MATCH = etag)[0], 412)
+        self.assertEqual(self.call('POST', '/~cork/a', "4", HTTP_IF_NONE_MATCH = '"1", "2"')[0], 200)
+        self.assertEqual(self.call('POST', '/~cork/b', "1", HTTP_IF_NONE_MATCH = etag)[0], 200) # not set, so not at any version
+        self.assertEqual(cork.state.copy(), {"a": "4", "b": "1"})
+
+    def testETag(self):
+        cork.state["a"] = "1"
+        status, output = self.call('GET', '/~cork/a')
+        etag = bottle.response.headers['ETag']
+        self.assertEqual(etag, '"%d"' % cork.state.version("a"))
+        self.assertEqual(self.call('GET', '/~cork/a', HTTP_IF_NONE_MATCH = etag), (304, ""))
+        cork.state["a"] = "2"
+        self.assertEqual(self.call('GET', '/~cork/a', HTTP_IF_NONE_MATCH = etag), (200, "2"))
+        self.assertEqual(self.call('GET', '/~cork/a', HTTP_IF_NONE_MATCH = "*"), (304, ""))
+        self.assertEqual(self.call('GET', '/~cork/b', HTTP_IF_NONE_MATCH = "*"), (200, ""))
+
+    def testIncrAppend(self):
+        self.assertEqual(self.call('POST', '/~cork/n', query = "op=incr"), (200, "1"))
+        self.assertEqual(self.call('POST', '/~cork/n', "10", query = "op=incr"), (200, "11"))
+        self.assertEqual(self.call('GET', '/~cork/n')[1], "11")
+        self.assertEqual(cork.state["n"], "11") # a string, like any other value set over HTTP
+        self.assertEqual(self.call('POST', '/~cork/n', "0", query = "op=append"), (200, "110"))
+        self.assertEqual(self.call('POST', '/~cork/log', "a,", query = "op=append"), (200, "a,"))
+        self.assertEqual(self.call('POST', '/~cork/log', "b", query = "op=append"), (200, "a,b"))
+        self.assertEqual(self.call('POST', '/~cork/log', query = "op=incr")[0], 409)
+        self.assertEqual(self.call('POST', '/~cork/n', "x", query = "op=incr")[0], 400)
+        self.assertEqual(self.call('POST', '/~cork/n', query = "op=nope")[0], 400)
+
+    def testSessions(self):
+        cork.state["a"] = "default"
+        self.call('POST', '/~cork/bulk', json.dumps({"a": "one"}), HTTP_X_CORK_SESSION = "one")
+        self.call('POST', '/~cork/a', "two", HTTP_COOKIE = "cork_session=two")
+        self.assertEqual(self.call('GET', '/~cork/a', HTTP_X_CORK_SESSION = "one")[1], "one")
+        self.assertEqual(self.call('GET', '/~cork', HTTP_X_CORK_SESSION = "two")[1], "a=two")
+        self.assertEqual(self.call('GET', '/~cork/a')[1], "default")
+        self.assertEqual(json.loads(self.call('GET', '/~cork/sessions')[1]), {"one": 1, "two": 1})
+        self.assertEqual(self.call('POST', '/~cork/end', HTTP_X_CORK_SESSION = "one")[0], 200)
+        self.assertEqual(self.call('POST', '/~cork/end')[0], 400)
+        self.assertEqual(cork.state.sessions(), {"two": 1})
+        self.assertEqual(cork.state.copy(), {"a": "default"}) # outside of a request
+        cork.state.end("two")
+
+    def testDump(self):
+        self.assertEqual(self.call('GET', '/~cork'), (200, ""))
+        cork.state.update(("user/%02d" % i, str(i)) for i in range(25))
+        cork.state.update(a = "1", z = u"\u00e9")
+        self.assertEqual(self.call('GET', '/~cork')[1].split("\n")[:2], ["a=1", "user/00=0"])
+        self.assertTrue(self.call('GET', '/~cork')[1].endswith("z=\xc3\xa9"))
+        pages, after = [], None
+        while True:
+            status, output = self.call('GET', '/~cork', query = "prefix=user/&limit=10" + ("&after=" + after if after else ""))
+            pages.append(output.split("\n"))
+            after = bottle.response.headers.get('X-Cork-Next')
+            if after is None:
+                break
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(pages[2][-1], "user/24=24")
+        self.assertEqual(self.call('GET', '/~cork', query = "limit=0")[0], 400)
+
+    def testTtl(self):
+        self.call('POST', '/~cork/a', "1", query = "ttl=60")
+        self.assertTrue(0 < cork.state._entry("a")[1] - time.time() <= 60)
+        self.call('POST', '/~cork/bulk', json.dumps({"b": "2"}), query = "ttl=30")
+        self.assertTrue(cork.state._entry("b")[1] is not None)
+        self.assertEqual(self.call('POST', '/~cork/c', "3", query = "ttl=-1")[0], 400)
+        self.assertEqual(json.loads(self.call('GET', '/~cork/stats')[1])["expiring"], 2)
+
+    def testGet(self):
+        cork.state.update(a = "1", b = "2", c = "3")
+        status, output = self.call('GET', '/~cork/bulk', query = "key=a&key=c&key=missing")
+        self.assertEqual((status, json.loads(output)), (200, {"a": "1", "c": "3", "missing": None}))
+        self.assertEqual(json.loads(self.call('GET', '/~cork/bulk')[1]), {"a": "1", "b": "2", "c": "3"})
+        cork.state.update(n = 0, o = object())
+        values = json.loads(self.call('GET', '/~cork/bulk', query = "key=n&key=o")[1])
+        self.assertEqual(values["n"], "0")
+        self.assertTrue(values["o"].startswith("<object object"))
+
+class TrieRouterTest(unittest.TestCase):
+    rules = ['/', '/static', '/users/<id:int>', '/users/<name>', '/users/<name>/posts/<post:int>',
+             '/users/me/settings', '/4040/<path:path>', '/4041/<path:path>', '/files/<name>.json',
+             '/price/<amount:float>', '/hex/<value:re:[0-9a-f]+>', '/<page>/edit', '/docs/<p:path>/raw',
+             '/anon/<>', '/<a>-<b>', '/trailing/', '/users/<name>/posts/latest']
+    paths = ['/', '/static', '/users/12', '/users/-3', '/users/bob', '/users/me/settings', '/users/bob/posts/7',
+             '/users/bob/posts/latest', '/users/bob/posts/x', '/users/', '/users', '/4040/', '/4040', '/4040/a/b.xml',
+             '/4041/x', '/files/report.json', '/files/report.xml', '/files/.json', '/price/1.5', '/price/1.2.3',
+             '/hex/ff', '/hex/zz', '/home/edit', '/docs/a/b/raw', '/docs/raw', '/anon/5', '/x-y', '/x-y-z',
+             '/trailing/', '/trailing', '/missing/entirely', '']
+
+    def route(self, router, path, method = 'GET'):
+        # what a router makes of a path, errors included
+        try:
+            return router.match({'PATH_INFO': path, 'REQUEST_METHOD': method})
+        except bottle.HTTPError, e:
+            return e.status, e.headers and e.headers.get('Allow')
+
+    def testSameAsRouter(self):
+        router, trie = bottle.Router(), cork.TrieRouter()
+        for rule in self.rules:
+            router.add(rule, 'GET', rule)
+            trie.add(rule, 'GET', rule)
+        trie.add('/users/<id:int>', 'POST', 'post')
+        router.add('/users/<id:int>', 'POST', 'post')
+        for path in self.paths:
+            for method in ('GET', 'HEAD', 'POST', 'PUT'):
+                self.assertEqual(self.route(trie, path, method), self.route(router, path, method), (path, method))
+        self.assertEqual(trie.build('/users/<id:int>', id = 5), '/users/5')
+
+    def testOrder(self):
+        trie = cork.TrieRouter()
+        trie.add('/<a>/<b>', 'GET', 'first')
+        trie.add('/x/y', 'GET', 'static')
+        trie.add('/x/<b>', 'GET', 'later')
+        self.assertEqual(self.route(trie, '/x/y'), ('static', {}))
+        self.assertEqual(self.route(trie, '/x/z'), ('first', {'a': 'x', 'b': 'z'}))
+        trie = cork.TrieRouter(strict = True)
+        trie.add('/<a>', 'GET', 'first')
+        trie.add('/x', 'GET', 'static')
+        self.assertEqual(self.route(trie, '/x'), ('first', {'a': 'x'}))
+
+    def testUseTrieRouter(self):
+        app = bottle.Bottle()
+        app.route('/one/<n:int>')(lambda n: str(n + 1))
+        router = cork.use_trie_router(app)
+        app.route('/two/<name>')(lambda name: name)
+        self.assertTrue(app.router is router)
+        self.assertEqual(router.match({'PATH_INFO': '/one/1', 'REQUEST_METHOD': 'GET'})[1], {'n': 1})
+        self.assertEqual(router.match({'PATH_INFO': '/two/x', 'REQUEST_METHOD': 'GET'})[1], {'name': 'x'})